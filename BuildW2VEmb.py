@@ -2,55 +2,114 @@ import pickle as pkl
 import gensim
 import argparse
 import logging
+import os
+from multiprocessing import Pool
 from utils import *
+from corpus import Corpus, is_corpus
+from tqdm import tqdm
 import itertools
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO) #gensim logging
 
 
-class Word_Iterator:
-    def __init__(self, fmtl,train_idx):
-        self.fmtl = fmtl
-        self.train_idx = train_idx
-        self.x = 0
-        self.stop = len(train_idx)
+def load_data(filename):
+    """
+    Columnar Corpus or pickled datadict, along with its sorted split numbers
+    """
+    if is_corpus(filename):
+        data = Corpus(filename)
+        return data,sorted(set(data.split.tolist()))
+
+    data = load_datadict(filename)
+    return data,sorted(set(data["splits"]))
+
+
+def review_lines(data):
+    """
+    Yields (split, line) for each review of a prepared dataset (Corpus or datadict):
+    line is the review's words separated by spaces, whitespace tokens left out.
+    """
+    if isinstance(data,Corpus):
+        corpus = data
+        vocab = [w if w is not None and len(w.strip()) > 0 else None for w in corpus.vocab] #whitespace isn't something we want.
+        for idx in tqdm(range(len(corpus)),desc="Writing training corpora"):
+            s_start,s_end = corpus.review_offsets[idx],corpus.review_offsets[idx+1]
+            words = corpus.tokens[corpus.sent_offsets[s_start]:corpus.sent_offsets[s_end]].tolist()
+            yield int(corpus.split[idx])," ".join(w for w in map(vocab.__getitem__,words) if w is not None)
+    else:
+        datadict = data
+        r_field = datadict["rows"].index("review")
+        for t,split in tqdm(zip(datadict["data"],datadict["splits"]),total=len(datadict["splits"]),desc="Writing training corpora"):
+            yield split," ".join(w for s in t[r_field] for w in s if len(w.strip()) > 0) #whitespace isn't something we want.
 
-    def __iter__(self):
-        self.field_gen = self.fmtl.field_gen("review",self.train_idx)
-        return self
 
-    def next(self):
-        try:
-            return list(x for x in itertools.chain.from_iterable(self.field_gen.__next__()) if len(x.strip())>0) #whitespace isn't something we want.
-        except:
-            raise StopIteration 
-    __next__ = next
+def write_corpora(args,data,splits):
+    """
+    Writes the line-sentence training corpus of each split (one review per line) in a single pass over the data:
+    a review is in the training set of every split but its own (see FMTL_train_val_test).
+    """
+    paths = {split:args.filename+"_w2v_s{}.corpus".format(split) for split in splits}
+    files = {split:open(path,"w",encoding="utf-8") for split,path in paths.items()}
+    seen = set()
 
+    for split,line in review_lines(data):
+        seen.add(split)
+        for s,f in files.items():
+            if s != split:
+                f.write(line+"\n")
 
-def build_save(datadict,args):
-    data_tl,(trainit,valit,testit) = FMTL_train_val_test(datadict["data"],datadict["splits"],args.split,validation=0.5,rows=datadict["rows"])
-    word_it = Word_Iterator(data_tl,trainit)
+    for f in files.values():
+        f.close()
+
+    missing = [split for split in splits if split not in seen]
+    if len(missing) > 0:
+        raise IndexError("Test set is empty - split {} probably doesn't exist".format(missing[0]))
+
+    return paths
 
-    w2vmodel = gensim.models.Word2Vec(word_it, size=args.emb_size, window=args.window, min_count=args.min_count, iter=args.epochs, max_vocab_size=args.dic_size, workers=args.threads)
-    print(len(w2vmodel.wv.vocab))
 
+def output_file(args,split):
     if args.output is None:
-        out_file = args.filename+"_w2v_s{}.txt".format(args.split)
+        return args.filename+"_w2v_s{}.txt".format(split)
+    if args.split < 0:
+        return args.output+"_s{}.txt".format(split)
+    return args.output
+
+
+def build_save(args,split,corpus_file):
+    """
+    Trains word2vec on a split's corpus file: gensim's workers read it directly, without python iteration.
+    """
+    w2vmodel = gensim.models.Word2Vec(corpus_file=corpus_file, size=args.emb_size, window=args.window, min_count=args.min_count, iter=args.epochs, max_vocab_size=args.dic_size, workers=args.threads)
+    print(len(w2vmodel.wv.vocab))
+
+    out_file = output_file(args,split)
+    w2vmodel.wv.save_word2vec_format(out_file,total_vec=len(w2vmodel.wv.vocab))
 
-    w2vmodel.wv.save_word2vec_format(out_file,total_vec=len(w2vmodel.wv.vocab))  
+    if not args.keep_corpus:
+        os.remove(corpus_file)
+
+    return out_file
 
 
 
 def main_func(args):
-    datadict = pkl.load(open(args.filename,"rb"))
+    data,splits = load_data(args.filename)
 
     if args.split < 0:
-        print("==> Building embeddings for each splits")
-        for split in set(datadict["splits"]):
-            build_save(datadict,args)
+        print("==> Building embeddings for each splits: {}".format(splits))
     else:
+        splits = [args.split]
         print("==> Building embeddings for split {}".format(args.split))
-        build_save(datadict,args)
+
+    corpora = write_corpora(args,data,splits)
+    del data
+
+    with Pool(max(1,min(args.jobs,len(splits)))) as pool:
+        outs = pool.starmap(build_save,((args,split,corpora[split]) for split in splits))
+
+    for split,out_file in zip(splits,outs):
+        print("split {} embeddings saved to {}".format(split,out_file))
 
 
 
@@ -64,7 +123,9 @@ if __name__ == '__main__':
     parser.add_argument("--dic-size", type=int,default=10000000)
     parser.add_argument("--epochs", type=int,default=1)
     parser.add_argument("--min-count", type=int,default=5)
-    parser.add_argument("--threads", type=int,default=4)
+    parser.add_argument("--threads", type=int,default=4, help="word2vec threads per split")
+    parser.add_argument("--jobs", type=int,default=1, help="splits trained at the same time (-1 split), each with --threads threads")
+    parser.add_argument("--keep-corpus", action="store_true", help="keeps the line-sentence training corpus files (<filename>_w2v_s<split>.corpus)")
     parser.add_argument("--window", type=int,default=5)
     parser.add_argument("--split", type=int, default=0)
 
@@ -72,4 +133,3 @@ if __name__ == '__main__':
 
 
     main_func(args)
-
@@ -1,15 +1,44 @@
 from collections import Counter
 from operator import itemgetter
 from collections import OrderedDict
-from random import choice, shuffle
+from random import choice, shuffle, random
 from tqdm import tqdm
 import itertools
+import numpy as np
 
 import torch
 import torch.utils.data as data
 import torch.nn.functional as fn
 from torch.utils.data import DataLoader, Dataset
 from torch.utils.data.sampler import Sampler
+from multiprocessing import Pool
+
+
+_shared = None # pool_map's obj, in its worker processes
+
+
+def _init_shared(obj):
+    global _shared
+    _shared = obj
+
+
+def _call_shared(task):
+    f,arg = task
+    return f(_shared,arg)
+
+
+def pool_map(f,obj,args,workers=0):
+    """
+    Lazy f(obj,arg) for arg in args, in order, computed by a pool of workers processes if > 0.
+    obj is handed to each worker once, by the pool initializer: inherited when forking, pickled under spawn.
+    f must be a module level function.
+    """
+    if workers <= 0:
+        yield from (f(obj,arg) for arg in args)
+        return
+
+    with Pool(workers,initializer=_init_shared,initargs=(obj,)) as pool:
+        yield from pool.imap(_call_shared,((f,arg) for arg in args))
 
 
 class TuplesListDataset(Dataset):
@@ -107,6 +136,7 @@ class TuplesListDataset(Dataset):
         pre-makes all transformations - usefull if they are heavy.
         inplace -> object is modified inplace
         keep_maps -> if inplace, to keep dictionnary mappings (functions are discarded.)
+        Review datasets are better prebuilt by utils.prebuild (in-memory columns, optionally in a pool of processes).
         """
         self._check_immutable() # already built.
 
@@ -184,8 +214,12 @@ class Vectorizer():
     def vectorize_batch(self,t,trim=True):
         return self._vect_dict(t,trim)
 
-    def _vect_dict(self,t,trim):
-
+    def vectorize_flat(self,t,trim=True):
+        """
+        Batch of tokenized reviews -> flat token ids, sentence offsets and review offsets (see flatten_reviews), in one pass:
+        reviews are cut to max_sent_len sentences and sentences to max_word_len words (if trim), words looked up with a single
+        map(dict.get) over the batch, then empty sentences are dropped and empty reviews get a single unknown word.
+        """
         if self.word_dict is None:
             print("No dictionnary to vectorize text \n-> call method build_dict \n-> or set a word_dict attribute \n first")
             raise Exception
@@ -193,30 +227,265 @@ class Vectorizer():
         if type(t) == str:
             t = [t]
 
-        revs = []
-        
-        for rev in t:
-            review = []
-            for j,sent in enumerate(rev):  
-
-                if trim and j>= self.max_sent_len:
-                    break
-                s = []
-                for k,word in enumerate(sent):
-
-                    if trim and k >= self.max_word_len:
-                        break
-
-                    if word in self.word_dict:
-                        s.append(self.word_dict[word])
-                    else:
-                        s.append(self.word_dict["_unk_word_"]) #_unk_word_
-                 
-                if len(s) >= 1:
-                    review.append(s)
-            if len(review) == 0:
-                review = [[self.word_dict["_unk_word_"]]]        
-            revs.append(review)
-
-        return revs
+        if trim:
+            t = [rev[:self.max_sent_len] for rev in t]
+            sents = [sent[:self.max_word_len] for sent in itertools.chain.from_iterable(t)]
+        else:
+            sents = list(itertools.chain.from_iterable(t))
+
+        sent_offsets = np.zeros(len(sents)+1,dtype=np.int64)
+        review_offsets = np.zeros(len(t)+1,dtype=np.int64)
+        np.cumsum(list(map(len,sents)),out=sent_offsets[1:])
+        np.cumsum(list(map(len,t)),out=review_offsets[1:])
+
+        unk = self.word_dict["_unk_word_"]
+        words = itertools.chain.from_iterable(sents)
+        tokens = np.fromiter(map(self.word_dict.get,words,itertools.repeat(unk)),dtype=np.int64,count=sent_offsets[-1])
+
+        return drop_empty(tokens,sent_offsets,review_offsets,unk)
+
+    def collate(self,t,trim=True):
+        """
+        Batch tensors of tokenized reviews, ready for the networks (see collate_flat)
+        """
+        return collate_flat(*self.vectorize_flat(t,trim))
+
+    def _vect_dict(self,t,trim):
+        return unflatten_reviews(*self.vectorize_flat(t,trim))
+
+
+
+def flatten_reviews(reviews):
+    """
+    list(list(list(int))) reviews -> flat token ids, sentence offsets in tokens and review offsets in sentences (corpus.py layout)
+    """
+    sents = list(itertools.chain.from_iterable(reviews))
+    sent_offsets = np.zeros(len(sents)+1,dtype=np.int64)
+    review_offsets = np.zeros(len(reviews)+1,dtype=np.int64)
+    np.cumsum(list(map(len,sents)),out=sent_offsets[1:])
+    np.cumsum(list(map(len,reviews)),out=review_offsets[1:])
+    tokens = np.fromiter(itertools.chain.from_iterable(sents),dtype=np.int64,count=sent_offsets[-1])
+    return tokens,sent_offsets,review_offsets
+
+
+def unflatten_reviews(tokens,sent_offsets,review_offsets):
+    """
+    flatten_reviews inverse: list(list(list(int))) reviews
+    """
+    ids,so,ro = tokens.tolist(),sent_offsets.tolist(),review_offsets.tolist()
+    sents = [ids[a:b] for a,b in zip(so[:-1],so[1:])]
+    return [sents[a:b] for a,b in zip(ro[:-1],ro[1:])]
+
+
+def drop_empty(tokens,sent_offsets,review_offsets,unk=1):
+    """
+    Flat reviews without empty sentences, reviews left empty get a single sentence of one unk token
+    """
+    sent_lens = np.diff(sent_offsets)
+    rev_lens = np.diff(review_offsets)
+
+    if sent_lens.all() and rev_lens.all():
+        return tokens,sent_offsets,review_offsets
+
+    keep = sent_lens > 0
+    rev_lens = np.bincount(np.repeat(np.arange(len(rev_lens)),rev_lens)[keep],minlength=len(rev_lens))
+    sent_lens = sent_lens[keep]
+
+    empty = np.flatnonzero(rev_lens == 0)
+    if len(empty) > 0:
+        s_pos = np.concatenate([[0],np.cumsum(rev_lens)])[empty]      # where their sentence goes
+        t_pos = np.concatenate([[0],np.cumsum(sent_lens)])[s_pos]     # where its token goes
+        sent_lens = np.insert(sent_lens,s_pos,1)
+        tokens = np.insert(tokens,t_pos,unk)
+        rev_lens[empty] = 1
+
+    sent_offsets = np.concatenate([[0],np.cumsum(sent_lens)]).astype(np.int64)
+    review_offsets = np.concatenate([[0],np.cumsum(rev_lens)]).astype(np.int64)
+    return tokens,sent_offsets,review_offsets
+
+
+def collate_flat(tokens,sent_offsets,review_offsets):
+    """
+    Vectorized batch preparation from flat reviews (see flatten_reviews):
+    - reviews are ordered by decreasing length (in sentences), sentences by decreasing length (in words), with stable argsorts
+    - batch_t is filled with a single scatter of all tokens
+    returns:
+    - batch_t:      sentence word ids, [number_of_sentences, max_sentence_length]
+    - sent_order:   index+1 in batch_t of each (review, sentence), 0 for padding, [number_of_reviews, max_review_length]
+    - ls, lr:       sentence lengths (words) and review lengths (sentences), ordered
+    - r_perm:       review ordering (reordered = original[r_perm])
+    - ui_indexs:    review (reordered) of each sentence of batch_t, [number_of_sentences]
+    """
+    sent_lens = np.diff(sent_offsets)
+    rev_lens = np.diff(review_offsets)
+    nb_sents,nb_revs = len(sent_lens),len(rev_lens)
+
+    r_perm = np.argsort(-rev_lens,kind="stable")
+    r_rank = np.empty_like(r_perm)
+    r_rank[r_perm] = np.arange(nb_revs)
+
+    s_perm = np.argsort(-sent_lens,kind="stable")
+    s_rank = np.empty_like(s_perm)
+    s_rank[s_perm] = np.arange(nb_sents)
+
+    sent_rev = np.repeat(np.arange(nb_revs),rev_lens)                    # original review of each sentence
+    sent_pos = np.arange(nb_sents) - np.repeat(review_offsets[:-1],rev_lens) # position of each sentence in its review
+    tok_sent = np.repeat(np.arange(nb_sents),sent_lens)                  # sentence of each token
+    tok_pos = np.arange(len(tokens)) - np.repeat(sent_offsets[:-1],sent_lens)
+
+    batch_t = np.zeros((nb_sents,sent_lens.max()),dtype=np.int64)
+    batch_t[s_rank[tok_sent],tok_pos] = tokens
+
+    sent_order = np.zeros((nb_revs,rev_lens.max()),dtype=np.int64)
+    sent_order[r_rank[sent_rev],sent_pos] = s_rank + 1 # 0 is for empty
+
+    ui_indexs = r_rank[sent_rev[s_perm]]
+
+    return torch.from_numpy(batch_t),torch.from_numpy(sent_order),sent_lens[s_perm].tolist(),rev_lens[r_perm].tolist(),r_perm,torch.from_numpy(ui_indexs)
+
+
+def review_batch(reviews):
+    """
+    collate_flat on list(list(list(int))) reviews
+    """
+    return collate_flat(*flatten_reviews(reviews))
+
+
+def review_lengths(fmtl,idxs,max_sents=-1,max_words=-1):
+    """
+    (nb sentences, longest sentence, nb tokens) arrays of the reviews in idxs, after trimming.
+    Vectorized for corpus.Corpus storage, else maps every review once.
+    """
+    if hasattr(fmtl.tuplelist,"lengths"):
+        return fmtl.tuplelist.lengths(idxs,max_sents,max_words)
+
+    stats = [(len(r),max(map(len,r),default=0),sum(map(len,r))) for r in tqdm(fmtl.field_gen("review",idxs),total=len(idxs),desc="Review lengths")]
+    return tuple(np.array(x,dtype=np.int64) for x in zip(*stats))
+
+
+def padding_stats(batches,lengths):
+    """
+    Share of real (non padding) cells in the padded tensors of these batches:
+    - words:     batch_t [number_of_sentences, max_sentence_length], embedded and attended at word level
+    - sentences: sent_order [number_of_reviews, max_review_length], attended at sentence level
+    """
+    nb_sents,longest,nb_tokens = lengths
+    real_w = pad_w = real_s = pad_s = 0
+
+    for b in batches:
+        b = np.asarray(b)
+        real_w += nb_tokens[b].sum()
+        pad_w += nb_sents[b].sum() * longest[b].max()
+        real_s += nb_sents[b].sum()
+        pad_s += len(b) * nb_sents[b].max()
+
+    return {"words":real_w/max(pad_w,1),"sentences":real_s/max(pad_s,1),"padded_words":int(pad_w),"real_words":int(real_w)}
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches reviews of similar lengths together to cut padding:
+    each epoch, shuffled indexes are split in pools of bucket_size batches, every pool is sorted by
+    (nb sentences, longest sentence) and cut in batches, then all batches are shuffled.
+    lengths: review_lengths() of the dataset, in dataset index order.
+    """
+
+    def __init__(self,lengths,batch_size,bucket_size=50,drop_last=False):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.batches = []
+
+    def _batches(self):
+        nb_sents,longest,_ = self.lengths
+        idxs = list(range(len(nb_sents)))
+        shuffle(idxs)
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+
+        for start in range(0,len(idxs),pool_size):
+            pool = sorted(idxs[start:start+pool_size],key=lambda i:(nb_sents[i],longest[i],random()))
+            batches.extend(pool[i:i+self.batch_size] for i in range(0,len(pool),self.batch_size))
+
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+
+        shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        self.batches = self._batches()
+        return iter(self.batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths[0]) // self.batch_size
+        return (len(self.lengths[0]) + self.batch_size - 1) // self.batch_size
+
+    def padding_efficiency(self):
+        return padding_efficiency(self.batches,self.lengths)
+
+
+def padding_efficiency(batches,lengths):
+    """
+    padding_stats of a sampler's last epoch batches, along with those of plain shuffled batches (of the same mean size) for reference
+    """
+    idxs = list(range(len(lengths[0])))
+    shuffle(idxs)
+    size = max(1,round(len(idxs)/max(len(batches),1)))
+    random_batches = [idxs[i:i+size] for i in range(0,len(idxs),size)]
+    return padding_stats(batches,lengths),padding_stats(random_batches,lengths)
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Dynamic batches packing reviews up to a budget of max_tokens padded word cells
+    (nb sentences x longest sentence, the size of batch_t), with at most max_sents sentences per batch (if > 0).
+    Reviews are sorted by length within pools of pool_size reviews, so batches of short reviews hold more of them.
+    A review over budget on its own makes a single review batch.
+    """
+
+    def __init__(self,lengths,max_tokens,max_sents=0,pool_size=1600):
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.max_sents = max_sents
+        self.pool_size = pool_size
+        self.batches = self._batches() # first epoch drawn ahead, so that __len__ is exact for it
+        self.drawn = True
+
+    def _batches(self):
+        nb_sents,longest,_ = self.lengths
+        idxs = list(range(len(nb_sents)))
+        shuffle(idxs)
+        batches = []
+
+        for start in range(0,len(idxs),self.pool_size):
+            pool = sorted(idxs[start:start+self.pool_size],key=lambda i:(nb_sents[i],longest[i],random()))
+            batch,sents,width = [],0,0
+
+            for i in pool:
+                n_sents,n_width = sents+nb_sents[i],max(width,longest[i])
+                if batch and (n_sents*n_width > self.max_tokens or (self.max_sents > 0 and n_sents > self.max_sents)):
+                    batches.append(batch)
+                    batch,n_sents,n_width = [],nb_sents[i],longest[i]
+                batch.append(i)
+                sents,width = n_sents,n_width
+
+            if batch:
+                batches.append(batch)
+
+        shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        if not self.drawn:
+            self.batches = self._batches()
+        self.drawn = False
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches) # last drawn epoch: an estimate of the next one's
 
+    def padding_efficiency(self):
+        return padding_efficiency(self.batches,self.lengths)
@@ -2,6 +2,111 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init as I
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence
+from typing import List, Optional
+
+
+def packed_segments(packed: PackedSequence):
+    """
+    Sequence index (in sorted order) of each row of a PackedSequence's data, shape: [num_words]
+    """
+    batch_sizes = packed.batch_sizes.to(packed.data.device)
+    starts = torch.cumsum(batch_sizes,0) - batch_sizes
+    return torch.arange(packed.data.size(0),device=packed.data.device) - torch.repeat_interleave(starts,batch_sizes)
+
+
+def segment_softmax(scores: Tensor,seg: Tensor,nb_segs: int):
+    """
+    Softmax of scores [num_words] within each segment of seg [num_words], shifted by the segment max (no exp overflow)
+    """
+    with torch.no_grad(): # softmax doesn't depend on the shift
+        shift = scores.new_full((nb_segs,),float("-inf")).scatter_reduce(0,seg,scores,"amax")
+    exp = torch.exp(scores - shift[seg])
+    sum_exp = exp.new_zeros(nb_segs).index_add(0,seg,exp)
+    return exp/sum_exp[seg]
+
+
+def pack_flat(offsets: Tensor):
+    """
+    Packing of the segments [offsets[i], offsets[i+1]) of a flat array (see Data.flatten_reviews), none of them empty:
+    flat index of each packed row (time major, segments by decreasing length), batch_sizes, sorted_indices and unsorted_indices
+    """
+    lens = offsets[1:] - offsets[:-1]
+    sorted_lens,sorted_indices = torch.sort(lens,descending=True,stable=True)
+    steps = torch.arange(int(sorted_lens[0]),device=offsets.device).unsqueeze(1) # [max_len, 1]
+    running = steps < sorted_lens.unsqueeze(0) # [max_len, num_segments], segments still running at each step
+    idxs = (offsets[:-1][sorted_indices].unsqueeze(0) + steps)[running]
+    unsorted_indices = torch.empty_like(sorted_indices).scatter_(0,sorted_indices,torch.arange(sorted_indices.size(0),device=offsets.device))
+    return idxs,running.sum(1).cpu(),sorted_indices,unsorted_indices
+
+
+class ConvEncoder(nn.Module):
+    """
+    Convolutional drop-in for the bidirectional rnns (same constructor and (output, _) = self(packed) call):
+    num_layers same-padded convolutions over each sequence, outputs of size hidden_size*2 at each step.
+    Steps are computed in parallel, each sees num_layers*(kernel_size-1)+1 neighbouring words.
+    """
+
+    def __init__(self, input_size, hidden_size, num_layers=1, bias=True, batch_first=True, dropout=0, bidirectional=True, kernel_size=3):
+        super(ConvEncoder, self).__init__()
+        sizes = [input_size] + [hidden_size*2]*max(num_layers,1)
+        self.convs = nn.ModuleList([nn.Conv1d(i,o,kernel_size,padding=kernel_size//2,bias=bias) for i,o in zip(sizes,sizes[1:])])
+
+    def forward(self, packed_batch: PackedSequence):
+        padded,lengths = torch.nn.utils.rnn.pad_packed_sequence(packed_batch,batch_first=True) # [num_seqs, max_len, input_size]
+        mask = (torch.arange(padded.size(1),device=padded.device).unsqueeze(0) < lengths.to(padded.device).unsqueeze(1)).unsqueeze(1).float() # [num_seqs, 1, max_len]
+
+        x = padded.transpose(1,2)
+        for conv in self.convs:
+            x = torch.tanh(conv(x)) * mask # padding stays 0 for the next layer
+
+        out = torch.nn.utils.rnn.pack_padded_sequence(x.transpose(1,2),lengths,batch_first=True,enforce_sorted=packed_batch.sorted_indices is None)
+        return out,None
+
+
+class QRNNEncoder(nn.Module):
+    """
+    Lightweight bidirectional recurrent drop-in for the rnns (quasi-recurrent, window of 1 word):
+    candidate, forget and output gates of every word come from a single linear layer, computed in parallel,
+    only the elementwise recurrence c_t = f_t * c_t-1 + (1-f_t) * z_t runs step by step (no matrix product per step).
+    """
+
+    def __init__(self, input_size, hidden_size, num_layers=1, bias=True, batch_first=True, dropout=0, bidirectional=True):
+        super(QRNNEncoder, self).__init__()
+        self.hidden_size = hidden_size
+        self.gates = nn.Linear(input_size,hidden_size*6,bias=bias) # (z, f, o) x (forward, backward)
+
+    def forward(self, packed_batch: PackedSequence):
+        h = self.hidden_size
+        z,f,o = self.gates(packed_batch.data).chunk(3,-1) # [num_words, hidden_size * 2] each
+        f = torch.sigmoid(f)
+        fz = (1-f) * torch.tanh(z)
+        steps: List[int] = packed_batch.batch_sizes.tolist() # sequences are a prefix of the sorted ones at each step
+        starts: List[int] = [0]
+        for n in steps:
+            starts.append(starts[-1]+n)
+
+        fwd: List[Tensor] = []
+        c = fz.new_zeros(steps[0],h)
+        for t,n in enumerate(steps):
+            c = f[starts[t]:starts[t]+n,:h] * c[:n] + fz[starts[t]:starts[t]+n,:h]
+            fwd.append(c)
+
+        bwd: List[Tensor] = []
+        c = fz.new_zeros(0,h)
+        for t in range(len(steps)-1,-1,-1):
+            n = steps[t]
+            c = torch.cat([c,c.new_zeros(n-c.size(0),h)]) # sequences ending at t start from 0
+            c = f[starts[t]:starts[t]+n,h:] * c + fz[starts[t]:starts[t]+n,h:]
+            bwd.append(c)
+        bwd.reverse()
+
+        out = torch.sigmoid(o) * torch.cat([torch.cat(fwd),torch.cat(bwd)],-1)
+        return PackedSequence(out,packed_batch.batch_sizes,packed_batch.sorted_indices,packed_batch.unsorted_indices),None
+
+
+ENCODERS = {"gru":nn.GRU,"lstm":nn.LSTM,"cnn":ConvEncoder,"qrnn":QRNNEncoder} # sequence encoders of AttentionalBiRNN (RNN_cell)
 
 
 class EmbedAttention(nn.Module):
@@ -10,6 +115,7 @@ class EmbedAttention(nn.Module):
         super(EmbedAttention, self).__init__()
         self.att_w = nn.Linear(att_size,1,bias=False)
 
+    @torch.jit.unused
     def forward(self,input,len_s):
         # input: [max_sent_len, num_sent, att_size]
         # len_s: [num_sent]
@@ -17,6 +123,11 @@ class EmbedAttention(nn.Module):
         out = self._masked_softmax(att,len_s).unsqueeze(-1) # [max_sent_len, num_sent, 1]
         return out
     
+    def packed(self,input: Tensor,seg: Tensor,nb_segs: int):
+        # input: [num_words, att_size], PackedSequence data (no padding)
+        # seg: [num_words] sequence of each word (see packed_segments)
+        att = self.att_w(input).squeeze(-1) # [num_words]
+        return segment_softmax(att,seg,nb_segs).unsqueeze(-1) # [num_words, 1]
     
     def _masked_softmax(self,mat,len_s):
         
@@ -45,17 +156,27 @@ class AttentionalBiRNN(nn.Module):
         self.emb_att = EmbedAttention(self.natt)
 
     
-    def forward(self, packed_batch):
+    def _pool(self,rnn_sents: PackedSequence,emb_h: Tensor,seg: Tensor):
+        """
+        Attention weighted sum of the packed rnn outputs of each sequence, in the input (unsorted) order
+        """
+        nb_seqs = int(rnn_sents.batch_sizes[0])
+        att = self.emb_att.packed(emb_h,seg,nb_seqs) # [num_words, 1]
+        pooled = rnn_sents.data.new_zeros(nb_seqs,rnn_sents.data.size(1)).index_add(0,seg,att * rnn_sents.data) # [num_sent, hidden_size * 2]
+
+        unsorted_indices = rnn_sents.unsorted_indices
+        if unsorted_indices is not None:
+            pooled = pooled[unsorted_indices]
+        return pooled
+
+    def forward(self, packed_batch: PackedSequence):
         
         rnn_sents,_ = self.rnn(packed_batch)
-        enc_sents,len_s = torch.nn.utils.rnn.pad_packed_sequence(rnn_sents) 
-        # enc_sents: [max_sentence_length, number_of_sentences, hidden_size * 2] note: batch_first is False
-        # len_s: [number_of_sentences]
+        # rnn_sents.data: [number_of_words, hidden_size * 2], every word of every sentence, no padding
 
-        emb_h = F.tanh(self.lin(enc_sents)) # [max_sentence_length, number_of_sentences, hidden_size * 2]
+        emb_h = torch.tanh(self.lin(rnn_sents.data)) # [number_of_words, hidden_size * 2]
 
-        attended = self.emb_att(emb_h,len_s) * enc_sents # [max_sent_len, num_sent, hidden_size * 2]
-        return attended.sum(0,True).squeeze(0) # [num_sent, hidden_size * 2]
+        return self._pool(rnn_sents,emb_h,packed_segments(rnn_sents)) # [num_sent, hidden_size * 2]
 
 
 
@@ -69,41 +190,74 @@ class UIAttentionalBiRNN(AttentionalBiRNN):
         self.att_h = nn.Linear(inp_size*2+self.natt,self.natt,bias=True)
         
         
-    def forward(self, packed_batch,user_embs,item_embs):
-        
+    def ui_projection(self,user_embs: Tensor,item_embs: Tensor):
+        """
+        User/item part of att_h (its weight split along the concatenation), once per user/item pair: [num_pairs, natt]
+        """
+        inp_size = user_embs.size(-1)
+        w_u,w_i = self.att_h.weight[:,:inp_size],self.att_h.weight[:,inp_size:2*inp_size]
+        return F.linear(user_embs,w_u) + F.linear(item_embs,w_i,self.att_h.bias)
+
+    def forward(self, packed_batch: PackedSequence,user_embs: Tensor,item_embs: Tensor,ui_indexs: Optional[Tensor]=None):
+        """
+        user_embs/item_embs: one row per sequence, or per review if ui_indexs gives the review of each sequence
+        """
         rnn_sents,_ = self.rnn(packed_batch)
-        enc_sents,len_s = torch.nn.utils.rnn.pad_packed_sequence(rnn_sents)
+        seg = packed_segments(rnn_sents)
+        seq = seg
+        sorted_indices = rnn_sents.sorted_indices
+        if sorted_indices is not None:
+            seq = sorted_indices[seg] # input order sequence of each word
+        if ui_indexs is not None:
+            seq = ui_indexs[seq]
 
-        uit = torch.cat([user_embs.expand_as(enc_sents),item_embs.expand_as(enc_sents),enc_sents],dim=-1)
-        summed = F.tanh(self.att_h(uit))
+        w_h = self.att_h.weight[:,-self.natt:]
+        summed = torch.tanh(F.linear(rnn_sents.data,w_h) + self.ui_projection(user_embs,item_embs)[seq]) # == att_h(cat([user,item,rnn output]))
 
-        return torch.sum(enc_sents * self.emb_att(summed,len_s),0)
+        return self._pool(rnn_sents,summed,seg)
 
 
 
 class HAN(nn.Module):
 
-    def __init__(self, ntoken, num_class, emb_size=200, hid_size=50):
+    def __init__(self, ntoken, num_class, emb_size=200, hid_size=50, aspect_classes=(), encoder="gru"):
         super(HAN, self).__init__()
 
+        self.encoder = encoder # ENCODERS key
         self.emb_size = emb_size
         self.embed = nn.Embedding(ntoken, emb_size,padding_idx=0)
-        self.word = AttentionalBiRNN(emb_size, hid_size)
-        self.sent = AttentionalBiRNN(hid_size*2, hid_size)
+        self.word = AttentionalBiRNN(emb_size, hid_size, RNN_cell=ENCODERS[encoder])
+        self.sent = AttentionalBiRNN(hid_size*2, hid_size, RNN_cell=ENCODERS[encoder])
         self.lin_out = nn.Linear(hid_size*2,num_class)
+        self.aspect_outs = nn.ModuleList([nn.Linear(hid_size*2,n) for n in aspect_classes]) # one more head per rated aspect, over the same doc_embs
 
     def set_emb_tensor(self,emb_tensor):
         self.emb_size = emb_tensor.size(-1)
         self.embed.weight.data = emb_tensor
 
     
-    def _reorder_sent(self,sents,sent_order):
-        
-        sents = F.pad(sents,(0,0,1,0)) # adds a 0 to the top, shape: [num_sent + 1, hidden_size * 2]
-        revs = sents[sent_order.view(-1)] # [num_reviews * max_review_len, hidden_size * 2]
-        revs = revs.view(sent_order.size(0),sent_order.size(1),sents.size(1)) # [num_reviews, max_review_len, hidden_size * 2]
+    def _output(self,doc_embs):
+        """
+        Overall rating logits [num_reviews, num_class], or a list [overall, aspect_1, ...] of logits for multi-aspect models
+        """
+        out = self.lin_out(doc_embs)
+
+        if len(self.aspect_outs) == 0:
+            return out
+
+        return [out] + [lin(doc_embs) for lin in self.aspect_outs]
 
-        return revs
+    def _pack_sent(self,sents,sent_order,lr):
+        """
+        Packed review sequences of sentence embeddings, gathered straight from sents (no padded copy):
+        reviews are sorted by decreasing length, so the valid sentence_order entries of each time step are a prefix.
+        """
+        steps = sent_order.t() # [max_review_len, num_reviews]
+        idxs = steps[steps > 0] - 1 # sentence index in sents of each review step, time major (PackedSequence data order)
+        lr = torch.as_tensor(lr,dtype=torch.long,device=torch.device("cpu"))
+        batch_sizes = (lr.unsqueeze(0) > torch.arange(int(lr[0])).unsqueeze(1)).sum(1) # reviews still running at each step
+
+        return torch.nn.utils.rnn.PackedSequence(sents[idxs],batch_sizes) # data: [num_sent, hidden_size * 2]
  
 
     def forward(self, batch_reviews,sent_order,ls,lr):
@@ -117,53 +271,102 @@ class HAN(nn.Module):
         emb_w = F.dropout(self.embed(batch_reviews),training=self.training) # [number_of_sentences, max_sentence_length, embedding_size]
         packed_sents = torch.nn.utils.rnn.pack_padded_sequence(emb_w, ls, batch_first=True)
         sent_embs = self.word(packed_sents) # [num_sent, hidden_size * 2]
-        rev_embs = self._reorder_sent(sent_embs,sent_order) # [num_reviews, max_review_len, hidden_size * 2]
-        packed_rev = torch.nn.utils.rnn.pack_padded_sequence(rev_embs, lr,batch_first=True)
+        packed_rev = self._pack_sent(sent_embs,sent_order,lr) # reviews as packed sequences of sentences
         doc_embs = self.sent(packed_rev) # [num_reviews, hidden_size * 2]
-        out = self.lin_out(doc_embs) # [num_reviews, num_class]
+        out = self._output(doc_embs) # [num_reviews, num_class] (per head)
 
         return out
 
 
 class NSCUPA(HAN):
 
-    def __init__(self, ntoken, nusers, nitems, num_class, emb_size=200, hid_size=100):
-        super(NSCUPA, self).__init__(ntoken, num_class, emb_size, hid_size)
+    def __init__(self, ntoken, nusers, nitems, num_class, emb_size=200, hid_size=100, aspect_classes=(), encoder="lstm"):
+        super(NSCUPA, self).__init__(ntoken, num_class, emb_size, hid_size, aspect_classes, encoder)
 
         self.users = nn.Embedding(nusers, emb_size)
         I.normal(self.users.weight.data,0.01,0.01)
         self.items = nn.Embedding(nitems, emb_size)
         I.normal(self.items.weight.data,0.01,0.01)
 
-        self.word = UIAttentionalBiRNN(emb_size, emb_size//2)
-        self.sent = UIAttentionalBiRNN(emb_size, emb_size//2)
+        self.word = UIAttentionalBiRNN(emb_size, emb_size//2, RNN_cell=ENCODERS[encoder])
+        self.sent = UIAttentionalBiRNN(emb_size, emb_size//2, RNN_cell=ENCODERS[encoder])
 
 
     def forward(self, batch_reviews,users,items,sent_order,ui_indexs,ls,lr):
         
-        u = users[ui_indexs]
-        i = items[ui_indexs]
-
         emb_w = F.dropout(self.embed(batch_reviews),training=self.training)
-        emb_u = F.dropout(self.users(u),training=self.training)
-        emb_i = F.dropout(self.items(i),training=self.training)
+        emb_u = self.users(users) # looked up once per review, sentences use their review's (ui_indexs)
+        emb_i = self.items(items)
         
         packed_sents = torch.nn.utils.rnn.pack_padded_sequence(emb_w, ls,batch_first=True)
        
-        sent_embs = self.word(packed_sents,emb_u,emb_i)
-        rev_embs = self._reorder_sent(sent_embs,sent_order)
+        if self.training: # one dropout mask per sentence: projected per sentence, still far fewer rows than words
+            word_u,word_i,word_ui = emb_u[ui_indexs],emb_i[ui_indexs],None
+        else:
+            word_u,word_i,word_ui = emb_u,emb_i,ui_indexs
 
-        packed_rev = torch.nn.utils.rnn.pack_padded_sequence(rev_embs, lr,batch_first=True)
+        sent_embs = self.word(packed_sents,F.dropout(word_u,training=self.training),F.dropout(word_i,training=self.training),word_ui)
+        packed_rev = self._pack_sent(sent_embs,sent_order,lr)
 
-        emb_u = F.dropout(self.users(users),training=self.training)
-        emb_i = F.dropout(self.items(items),training=self.training)
+        doc_embs = self.sent(packed_rev,F.dropout(emb_u,training=self.training),F.dropout(emb_i,training=self.training))
 
-        doc_embs = self.sent(packed_rev,emb_u,emb_i)
+        out = self._output(doc_embs)
+
+        return out
 
-        out = self.lin_out(doc_embs)
 
+
+class HANInference(nn.Module):
+    """
+    TorchScript-able inference view of a trained HAN, sharing its modules (see export.py).
+    Takes flat reviews (tokens, sent_offsets, review_offsets as in Data.flatten_reviews) and packs them itself:
+    no collate, no python lists, outputs [overall, *aspects] logits in review order.
+    """
+
+    def __init__(self, net):
+        super(HANInference, self).__init__()
+        self.embed = net.embed
+        self.word = net.word
+        self.sent = net.sent
+        self.lin_out = net.lin_out
+        self.aspect_outs = net.aspect_outs
+
+    def _output(self, doc_embs: Tensor) -> List[Tensor]:
+        out = [self.lin_out(doc_embs)]
+        for lin in self.aspect_outs:
+            out.append(lin(doc_embs))
         return out
 
+    def forward(self, tokens: Tensor, sent_offsets: Tensor, review_offsets: Tensor) -> List[Tensor]:
+        idxs,batch_sizes,sorted_indices,unsorted_indices = pack_flat(sent_offsets)
+        sent_embs = self.word(PackedSequence(self.embed(tokens[idxs]),batch_sizes,sorted_indices,unsorted_indices)) # [num_sent, hidden_size * 2], in flat order
+
+        idxs,batch_sizes,sorted_indices,unsorted_indices = pack_flat(review_offsets)
+        doc_embs = self.sent(PackedSequence(sent_embs[idxs],batch_sizes,sorted_indices,unsorted_indices)) # [num_reviews, hidden_size * 2]
+
+        return self._output(doc_embs)
+
+
+class NSCUPAInference(HANInference):
+    """
+    HANInference of a trained NSCUPA, users and items are given as ids (one per review)
+    """
+
+    def __init__(self, net):
+        super(NSCUPAInference, self).__init__(net)
+        self.users = net.users
+        self.items = net.items
+
+    def forward(self, tokens: Tensor, sent_offsets: Tensor, review_offsets: Tensor, users: Tensor, items: Tensor) -> List[Tensor]:
+        emb_u = self.users(users)
+        emb_i = self.items(items)
+        rev_lens = review_offsets[1:] - review_offsets[:-1]
+        ui_indexs = torch.repeat_interleave(torch.arange(rev_lens.size(0),device=tokens.device),rev_lens) # review of each sentence
 
+        idxs,batch_sizes,sorted_indices,unsorted_indices = pack_flat(sent_offsets)
+        sent_embs = self.word(PackedSequence(self.embed(tokens[idxs]),batch_sizes,sorted_indices,unsorted_indices),emb_u,emb_i,ui_indexs)
 
+        idxs,batch_sizes,sorted_indices,unsorted_indices = pack_flat(review_offsets)
+        doc_embs = self.sent(PackedSequence(sent_embs[idxs],batch_sizes,sorted_indices,unsorted_indices),emb_u,emb_i)
 
+        return self._output(doc_embs)
@@ -1,21 +1,105 @@
 import argparse
-import re
-from random import shuffle
+import os
+import codecs
 import json
 import gzip
+from collections import deque
+from multiprocessing import Pool
+from dedup import Deduplicator
 
 # Helper script to convert beeradvocate/ratebeer datasets to json format.
+# (or straight to prepare_data.py's output formats with --format columnar/pickle)
+
+FIELDS = {"beer/beerId":0,"review/profileName":1,"review/text":2,"review/overall":3,"review/time":4,
+          "review/appearance":5,"review/aroma":6,"review/palate":7,"review/taste":8} # line prefix -> (item, user, text, rating, time, *aspects) index
+ASPECTS = ("appearance","aroma","palate","taste")
+
+
+def rb_rating(val):
+    #putting rating on 0-5 scale
+    val = val.split("/")
+    return (float(val[0])/float(val[1])) * 5
+
+
+def iter_lines(f,encoding="utf-8",chunk_size=1<<24):
+    """
+    Lines of a binary file, decoded chunk by chunk rather than line by line
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="ignore")
+    rest = ""
+
+    for chunk in iter(lambda: f.read(chunk_size),b""):
+        lines = (rest + decoder.decode(chunk)).split("\n")
+        rest = lines.pop()
+        yield from lines
+
+    rest += decoder.decode(b"",final=True)
+    if rest:
+        yield rest
+
+
+def parse_lines(lines,rb=False,aspects=False):
+    """
+    Yields (item, user, text, rating, time, *aspects) reviews: field lines are dispatched on their prefix,
+    a review is complete on the blank line following its five fields (and aspect scores if aspects).
+    Missing aspect scores are None.
+    """
+    rev = [None]*len(FIELDS)
+    needed = len(FIELDS) if aspects else 5
+
+    for line in lines:
+        field = FIELDS.get(line.partition(":")[0])
+
+        if field is not None and field < needed:
+            val = line.split(" ",1)
+            if len(val) == 2:
+                val = val[1].strip()
+                rev[field] = rb_rating(val) if rb and field >= 3 and field != 4 else val
+
+        elif line == "" or line == "\r":
+            if None not in rev[:needed]:
+                yield tuple(rev)
+                rev = [None]*len(FIELDS)
+
+
+def byte_ranges(path,size):
+    """
+    Splits an uncompressed dump in (start,end) byte ranges of about size bytes, cut after blank lines (review boundaries)
+    """
+    total = os.path.getsize(path)
+    ranges = []
+    start = 0
+
+    with open(path,"rb") as f:
+        while start < total:
+            f.seek(start+size)
+            f.readline()
+            line = f.readline()
+            while line and line.strip():
+                line = f.readline()
+            end = min(f.tell(),total)
+            ranges.append((start,end))
+            start = end
+
+    return ranges
+
+
+def parse_range(path,start,end,encoding,rb,aspects):
+    """
+    Pool task: reviews of a byte range (see byte_ranges)
+    """
+    with open(path,"rb") as f:
+        f.seek(start)
+        text = f.read(end-start).decode(encoding,errors="ignore")
+    return list(parse_lines(text.split("\n"),rb,aspects))
+
 
 class DatasetGenerator(object):
 
-    def __init__(self,dataset,zipped=True,encoding="utf-8"):
+    def __init__(self,dataset,zipped=True,encoding="utf-8",dedup=None,aspects=False):
         self.dataset = dataset
-        self.itemPat = re.compile('^beer/beerId:')
-        self.userPat = re.compile('^review/profileName:')
-        self.textPat = re.compile('^review/text:')
-        self.ratingPat = re.compile('^review/overall:')
-        self.timePat = re.compile('^review/time:')
-        self.reviewSep = re.compile('^$')
+        self.aspects = aspects # only reviews with all aspect scores are kept
+        self.dedup = dedup # Deduplicator dropping repeated reviews, if any
         self.zipped = zipped
         self.encoding = encoding
         self.f = None
@@ -30,118 +114,164 @@ class DatasetGenerator(object):
 
     def open_reset_file(self):
         if self.zipped:
-            self.f = gzip.open(self.dataset, "r")
+            self.f = gzip.open(self.dataset, "rb")
         else:
-            self.f = open(self.dataset, "r",encoding=self.encoding)
-        
+            self.f = open(self.dataset, "rb")
+
+        dedup,self.dedup = self.dedup,None # the detection pass mustn't mark the first review as seen
         for x in self:
             if len(x[3].split("/")) == 2:
                 print("Detected ratebeer corpus")
-                self.rb = True 
+                self.rb = True
             else:
                 print("Detected beeradvocate corpus")
                 self.rb = False
             break
 
+        self.dedup = dedup
         self.f.seek(0)
 
     def rb_rating(self,val):
-        #putting rating on 0-5 scale
-        val = val.split("/")
-        return (float(val[0])/float(val[1])) * 5
-
-  
+        return rb_rating(val)
 
     def __iter__(self):
         dupeCount = 0
-        item = None
-        user = None
-        text = None
-        rating = None
-        times = None
         i = 0
 
         if self.f is None:
             self.open_reset_file()
 
-        f = self.f
-        
-
-        for line in f:
-            if self.zipped:
-                line = line.decode(self.encoding,errors="ignore")
-
-            if(self.itemPat.search(line)):
-                val = self.split_getLast(line)
-
-                if val is None:
-                    continue
-                else:
-                    item = val
-
-            if(self.userPat.search(line)):
-                val = self.split_getLast(line)
-
-                if val is None:
-                    continue
-                else:
-                    user = val
-
-            if(self.textPat.search(line)):
-                val = self.split_getLast(line)
-                if val is None:
-                    continue
-                else:
-                    text = val
-
-            if(self.ratingPat.search(line)):
-                val = self.split_getLast(line)
-                if val is None:
-                    continue
-                else:
-                    if self.rb:
-                        val = self.rb_rating(val)
-                    rating = val
-
-            if(self.timePat.search(line)):
-                val = self.split_getLast(line)
-                if val is None:
-                    continue
-                else:
-                    times = val
-
-            if(self.reviewSep.search(line)):
-                if item is not None and user is not None and text is not None and rating is not None and times is not None:
-                
-                    yield((item, user, text, rating, times))
-
-                    item = user = text = rating = times = None
-                    i += 1
-                    if i % 10000 == 0:
-                        print("found {} reviews, {} exact duplicates".format(i, dupeCount))
-        print("Found {} reviews, {} exact duplicates".format(i, dupeCount))
+        for rev in parse_lines(iter_lines(self.f,self.encoding),self.rb,self.aspects):
+            item, user, text = rev[:3]
 
+            if self.dedup is not None and self.dedup.duplicates([self.dedup.key(user,item,text)])[0]:
+                dupeCount += 1
+            else:
+                yield rev
+
+            i += 1
+            if i % 10000 == 0:
+                print("found {} reviews, {} duplicates".format(i, dupeCount))
+        print("Found {} reviews, {} duplicates{}".format(i, dupeCount, "" if self.dedup is not None else " (not checked, see --dedup)"))
+
+
+def to_json(review,aspects=False):
+    i,u,rev,rat,ts = review[:5]
+    z = {"reviewerID":u,"asin":i,"reviewText":rev,"overall":rat,"unixReviewTime":ts,"summary":rev[:32]}
+    if aspects:
+        z["aspects"] = {a:float(v) for a,v in zip(ASPECTS,review[5:])}
+    return z
+
+
+def review_batches(args,data_iterator,pool):
+    """
+    Lists of reviews: byte ranges parsed by the pool for uncompressed dumps, else batches of the sequential parser.
+    With a pool, at most args.workers ranges are in flight.
+    """
+    if pool is None or args.zipped:
+        batch = []
+        for rev in data_iterator:
+            batch.append(rev)
+            if len(batch) == args.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+        return
+
+    ranges = iter(byte_ranges(args.data,args.chunk_size<<20))
+    pending = deque()
+    dedup = data_iterator.dedup
+    count = 0
+
+    def submit():
+        r = next(ranges,None)
+        if r is not None:
+            pending.append(pool.apply_async(parse_range,(args.data,r[0],r[1],args.encoding,data_iterator.rb,args.aspects)))
+
+    for _ in range(args.workers):
+        submit()
+
+    while len(pending) > 0:
+        batch = pending.popleft().get()
+        submit()
+        count += len(batch)
+        if dedup is not None:
+            batch = dedup.filter(batch,key=lambda r:(r[1],r[0],r[2]))
+        print("found {} reviews".format(count))
+        yield batch
+
+    if dedup is not None:
+        print(dedup.report())
 
 
 def run(args):
 
-    data_iterator = DatasetGenerator(args.data,zipped=args.zipped,encoding=args.encoding)
+    dedup = Deduplicator(args.dedup_capacity) if args.dedup else None
+    data_iterator = DatasetGenerator(args.data,zipped=args.zipped,encoding=args.encoding,dedup=dedup,aspects=args.aspects)
+    data_iterator.open_reset_file()
 
-    with gzip.open(args.output+'.gz', 'wb') as out:
-    
-        for i,u,rev,rat,ts in data_iterator:
-            a = json.dumps({"reviewerID":u,"asin":i,"reviewText":rev,"overall":rat,"unixReviewTime":ts,"summary":rev[:32]})
-            out.write((a+"\n").encode("utf-8"))
-       
+    if args.format == "json":
+        pool = Pool(args.workers) if args.workers > 0 else None
 
+        with gzip.open(args.output+'.gz', 'wb') as out:
+            for batch in review_batches(args,data_iterator,pool):
+                out.write("".join(json.dumps(to_json(rev,args.aspects))+"\n" for rev in batch).encode("utf-8"))
+    else:
+        # skips the json round trip: tokenized with prepare_data's backends and written in its formats
+        from prepare_data import open_writer, make_splits, tokenize_chunk, _init_tokenizer
 
-parser = argparse.ArgumentParser()
-parser.add_argument("data", type=str)
-parser.add_argument("output",type=str)
-parser.add_argument("--encoding",default="utf-8", type=str)
-parser.add_argument('--gz', dest='zipped', action='store_true')
-args = parser.parse_args()
+        aspects = ASPECTS if args.aspects else ()
+        args.aspects = list(aspects) # extra rating rows of the output (see prepare_data.output_rows)
+
+        pool = Pool(args.workers,initializer=_init_tokenizer,initargs=(args.tokenizer,)) if args.workers > 0 else None
+        writer = open_writer(args)
+        pending = deque()
+
+        def collect(res):
+            _,_,data = res
+            writer.write(data,make_splits(data,args))
+
+        if pool is None:
+            _init_tokenizer(args.tokenizer)
+
+        for batch in review_batches(args,data_iterator,pool):
+            records = [dict(to_json(rev,aspects),overall=float(rev[3])) for rev in batch]
+            if pool is None:
+                collect(tokenize_chunk(records,aspects))
+            else:
+                pending.append(pool.apply_async(tokenize_chunk,(records,aspects)))
+                while len(pending) >= args.workers:
+                    collect(pending.popleft().get())
+
+        while len(pending) > 0:
+            collect(pending.popleft().get())
+
+        writer.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
-    run(args)
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("data", type=str)
+    parser.add_argument("output",type=str)
+    parser.add_argument("--encoding",default="utf-8", type=str)
+    parser.add_argument('--gz', dest='zipped', action='store_true')
+    parser.add_argument("--dedup", action="store_true", help="drops reviews with the same user, beer and normalized text")
+    parser.add_argument("--dedup-capacity", type=int, default=10000000, help="reviews the dedup filter is sized for")
+    parser.add_argument("--workers", type=int, default=0, help="processes parsing byte ranges of uncompressed dumps (and tokenizing, for --format columnar/pickle)")
+    parser.add_argument("--chunk-size", type=int, default=64, help="MB of dump per parsed byte range")
+    parser.add_argument("--batch-size", type=int, default=20000, help="reviews per batch when parsing sequentially (gzip dumps or no --workers)")
+    parser.add_argument("--format", choices=["json","columnar","pickle"], default="json", help="json: gzipped json for prepare_data.py, columnar/pickle: prepare_data.py's output formats, tokenized directly")
+    parser.add_argument("--tokenizer", choices=["rules","spacy"], default="spacy", help="tokenizer backend for --format columnar/pickle (see prepare_data.py)")
+    parser.add_argument("--aspects", action="store_true", help="keeps appearance/aroma/palate/taste scores (json \"aspects\" field, extra rating rows for --format columnar/pickle)")
+    parser.add_argument("--nb_splits", type=int, default=5)
+    parser.add_argument("--splits", choices=["random","hash"], default="random")
+    parser.set_defaults(append=False)
+    args = parser.parse_args()
+
+    run(args)
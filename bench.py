@@ -0,0 +1,274 @@
+#bench.py
+import argparse
+import itertools
+import random
+import time
+import numpy as np
+
+from fmtl import FMTL
+
+# Microbenchmarks of the data pipeline and network layers, on synthetic data.
+
+
+def synthetic_reviews(nb_reviews,vocab_size,max_sents=15,max_words=40,seed=1337):
+    rand = random.Random(seed)
+    vocab = ["w{}".format(i) for i in range(vocab_size)]
+    return [("u{}".format(rand.randrange(100)),"i{}".format(rand.randrange(100)),
+             [[rand.choice(vocab) for _ in range(rand.randint(1,max_words))] for _ in range(rand.randint(1,max_sents))],
+             float(rand.randint(1,5))) for _ in range(nb_reviews)], vocab
+
+
+def timeit(f,repeat):
+    start = time.time()
+    for _ in range(repeat):
+        f()
+    return (time.time()-start)/repeat
+
+
+def bench_mapping(args):
+    """
+    FMTL review mapping: recursive _rec_apply (former __getitem__ path) vs DictMapper, per review and per batch
+    """
+    data,vocab = synthetic_reviews(args.nb_reviews,args.vocab_size)
+    wdict = {w:i for i,w in enumerate(vocab[:args.vocab_size//2],2)} # half the words are unknown
+    fmtl = FMTL(data,("user_id","item_id","review","rating"))
+    fmtl.set_mapping("review",wdict,unk=1)
+    mapper = fmtl.compiled[2]
+    reviews = [x[2] for x in data]
+    nb_words = sum(len(s) for r in reviews for s in r)
+
+    rec = timeit(lambda: [fmtl._rec_apply(wdict.__getitem__,r,1) for r in reviews],args.repeat)
+    per_review = timeit(lambda: [mapper(r) for r in reviews],args.repeat)
+    batched = timeit(lambda: [mapper.map_batch(reviews[i:i+args.b_size]) for i in range(0,len(reviews),args.b_size)],args.repeat)
+
+    assert [fmtl._rec_apply(wdict.__getitem__,r,1) for r in reviews] == mapper.map_batch(reviews)
+
+    print("{} reviews, {} words".format(len(reviews),nb_words))
+    for name,t in (("_rec_apply",rec),("DictMapper",per_review),("DictMapper.map_batch (b_size={})".format(args.b_size),batched)):
+        print("{:<40} {:8.3f}s  {:10.0f} words/s  x{:.1f}".format(name,t,nb_words/t,rec/t))
+
+
+def synthetic_texts(nb_reviews,seed=1337):
+    rand = random.Random(seed)
+    words = "the this it was is a very good bad product I don't it's works great would buy again Mr. price $3.50 e.g.".split()
+    return [" ".join(rand.choice(words).capitalize() + " " + " ".join(rand.choice(words) for _ in range(rand.randint(2,25))) + rand.choice([".","!","?","...","!!"])
+                     for _ in range(rand.randint(1,12))) for _ in range(nb_reviews)]
+
+
+def length_stats(values):
+    values = np.asarray(values)
+    return "mean {:6.2f}  p50 {:4.0f}  p90 {:4.0f}  p99 {:4.0f}  max {:5d}".format(values.mean(),*np.percentile(values,(50,90,99)),values.max())
+
+
+def bench_tokenizer(args):
+    """
+    prepare_data tokenizer backends: reviews/sec and resulting sentence length distributions
+    """
+    from prepare_data import TOKENIZERS, data_generator
+
+    if args.input:
+        texts = [z["reviewText"] for z in itertools.islice(data_generator(args.input),args.nb_reviews)]
+    else:
+        texts = synthetic_texts(args.nb_reviews)
+
+    print("{} reviews".format(len(texts)))
+    results = {}
+    for name in args.backends:
+        try:
+            tokenizer = TOKENIZERS[name]()
+        except (ImportError,IOError,OSError) as e:
+            print("{:<8} unavailable ({})".format(name,e))
+            continue
+
+        start = time.time()
+        results[name] = list(tokenizer.pipe(texts))
+        t = time.time()-start
+
+        print("{:<8} {:8.3f}s  {:10.1f} reviews/s".format(name,t,len(texts)/t))
+        print("         sentences/review: " + length_stats([len(r) for r in results[name]]))
+        print("         words/sentence:   " + length_stats([len(s) for r in results[name] for s in r] or [0]))
+
+    for a,b in itertools.combinations(sorted(results),2):
+        same = sum(len(x) == len(y) for x,y in zip(results[a],results[b]))
+        print("{} vs {}: same number of sentences on {:.1%} of reviews".format(a,b,same/max(len(texts),1)))
+
+
+
+def peak_memory(f,cuda=False):
+    """
+    Peak bytes allocated by f(), over what was allocated before: CUDA allocator stats, or the profiler's CPU allocation events
+    """
+    import torch
+
+    if cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        f()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU],profile_memory=True) as prof:
+        f()
+
+    current = peak = 0
+    for e in sorted(prof.events(),key=lambda e:e.time_range.start):
+        current += e.self_cpu_memory_usage
+        peak = max(peak,current)
+    return peak
+
+
+def bench_attention(args):
+    """
+    Attention pooling of rnn outputs, forward + backward: padded (pad_packed_sequence + masked softmax) vs packed (segment softmax)
+    """
+    import torch
+    from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+    from Nets import AttentionalBiRNN, packed_segments
+
+    torch.manual_seed(1337)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    net = AttentionalBiRNN(args.hid_size*2,args.hid_size).to(device)
+
+    # ragged: most sequences are short, a few reach max_len
+    lengths = torch.clamp(torch.distributions.LogNormal(2.5,0.8).sample((args.nb_seqs,)).long(),1,args.max_len)
+    lengths[0] = args.max_len
+    lengths = lengths.sort(descending=True)[0]
+    padded = torch.randn(args.nb_seqs,args.max_len,args.hid_size*2,device=device)
+    rnn_out = pack_padded_sequence(padded,lengths,batch_first=True)
+    rnn_out.data.requires_grad_()
+
+    def pool_padded():
+        enc_sents,len_s = pad_packed_sequence(rnn_out)
+        emb_h = torch.tanh(net.lin(enc_sents))
+        out = (net.emb_att(emb_h,len_s) * enc_sents).sum(0)
+        out.sum().backward()
+        return out
+
+    def pool_packed():
+        emb_h = torch.tanh(net.lin(rnn_out.data))
+        out = net._pool(rnn_out,emb_h,packed_segments(rnn_out))
+        out.sum().backward()
+        return out
+
+    diff = (pool_padded()-pool_packed()).abs().max().item()
+    print("{} sequences, {} words, {:.1%} padding at max length {}, max abs diff {:.2e}".format(args.nb_seqs,int(lengths.sum()),1-lengths.sum().item()/(args.nb_seqs*args.max_len),args.max_len,diff))
+
+    for name,f in (("padded",pool_padded),("packed",pool_packed)):
+        f() # warmup
+        t = timeit(f,args.repeat)
+        mem = peak_memory(f,args.cuda)
+        print("{:<8} {:8.2f}ms  peak {:8.1f}MB".format(name,t*1000,mem/2**20))
+
+
+
+def synthetic_labeled(nb_reviews,vocab_size,nb_class=5,max_sents=15,max_words=40,seed=1337):
+    """
+    Word id reviews whose class shows through a few class specific words among noise words
+    """
+    rand = random.Random(seed)
+    reviews,labels = [],[]
+    for _ in range(nb_reviews):
+        c = rand.randrange(nb_class)
+        review = [[rand.randrange(2+nb_class*10,vocab_size) for _ in range(rand.randint(1,max_words))] for _ in range(rand.randint(1,max_sents))]
+        for _ in range(3):
+            s = rand.choice(review)
+            s[rand.randrange(len(s))] = 2 + c*10 + rand.randrange(10)
+        reviews.append(review)
+        labels.append(c)
+    return reviews,labels
+
+
+def bench_encoders(args):
+    """
+    Encoders of Nets.ENCODERS side by side, on a synthetic task: test accuracy, training and inference reviews/s
+    """
+    import torch
+    from Nets import HAN, NSCUPA, ENCODERS
+    from Data import review_batch
+
+    torch.manual_seed(1337)
+    reviews,labels = synthetic_labeled(args.nb_reviews,args.vocab_size)
+    split = int(len(reviews)*0.8)
+
+    def batches(lo,hi):
+        for i in range(lo,hi,args.b_size):
+            batch_t,sent_order,ls,lr,r_perm,ui_indexs = review_batch(reviews[i:min(i+args.b_size,hi)])
+            y = torch.LongTensor([labels[i+j] for j in r_perm])
+            users = torch.zeros(len(lr),dtype=torch.long)
+            inputs = (batch_t,users,users,sent_order,ui_indexs,ls,lr) if args.model == "nscupa" else (batch_t,sent_order,ls,lr)
+            yield inputs,y
+
+    train_batches,test_batches = list(batches(0,split)),list(batches(split,len(reviews)))
+    print("{} {} reviews ({} test), batches of {}".format(args.model,len(reviews),len(reviews)-split,args.b_size))
+    print("{:<8} {:>9} {:>14} {:>14}".format("encoder","accuracy","train rev/s","infer rev/s"))
+
+    for name in args.encoders or sorted(ENCODERS):
+        if args.model == "nscupa":
+            net = NSCUPA(args.vocab_size,1,1,5,emb_size=args.hid_size*2,hid_size=args.hid_size,encoder=name)
+        else:
+            net = HAN(args.vocab_size,5,emb_size=args.emb_size,hid_size=args.hid_size,encoder=name)
+        optimizer = torch.optim.Adam(net.parameters())
+        criterion = torch.nn.CrossEntropyLoss()
+
+        net.train()
+        start = time.time()
+        for _ in range(args.epochs):
+            for inputs,y in train_batches:
+                optimizer.zero_grad()
+                criterion(net(*inputs),y).backward()
+                optimizer.step()
+        train_speed = args.epochs*split/(time.time()-start)
+
+        net.eval()
+        ok = 0
+        start = time.time()
+        with torch.no_grad():
+            for inputs,y in test_batches:
+                ok += (net(*inputs).argmax(-1) == y).sum().item()
+        infer_speed = (len(reviews)-split)/(time.time()-start)
+
+        print("{:<8} {:>8.1%} {:>14.1f} {:>14.1f}".format(name,ok/(len(reviews)-split),train_speed,infer_speed))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Data pipeline and network microbenchmarks")
+    subparsers = parser.add_subparsers(dest="bench")
+    subparsers.required = True
+
+    p = subparsers.add_parser("mapping",help=bench_mapping.__doc__)
+    p.add_argument("--nb-reviews",type=int,default=5000)
+    p.add_argument("--vocab-size",type=int,default=20000)
+    p.add_argument("--b-size",type=int,default=32)
+    p.add_argument("--repeat",type=int,default=3)
+    p.set_defaults(func=bench_mapping)
+
+    p = subparsers.add_parser("tokenizer",help=bench_tokenizer.__doc__)
+    p.add_argument("--input",type=str,help="gzip json reviews file (synthetic reviews if not given)")
+    p.add_argument("--nb-reviews",type=int,default=5000)
+    p.add_argument("--backends",nargs="+",default=["rules","spacy"])
+    p.set_defaults(func=bench_tokenizer)
+
+    p = subparsers.add_parser("attention",help=bench_attention.__doc__)
+    p.add_argument("--nb-seqs",type=int,default=512)
+    p.add_argument("--max-len",type=int,default=200)
+    p.add_argument("--hid-size",type=int,default=50)
+    p.add_argument("--repeat",type=int,default=10)
+    p.add_argument("--cuda",action="store_true")
+    p.set_defaults(func=bench_attention)
+
+    p = subparsers.add_parser("encoders",help=bench_encoders.__doc__)
+    p.add_argument("--model",choices=["han","nscupa"],default="han")
+    p.add_argument("--encoders",nargs="+",help="ENCODERS keys (all if not given)")
+    p.add_argument("--nb-reviews",type=int,default=3000)
+    p.add_argument("--vocab-size",type=int,default=5000)
+    p.add_argument("--emb-size",type=int,default=100)
+    p.add_argument("--hid-size",type=int,default=50)
+    p.add_argument("--b-size",type=int,default=32)
+    p.add_argument("--epochs",type=int,default=3)
+    p.set_defaults(func=bench_encoders)
+
+    args = parser.parse_args()
+    args.func(args)
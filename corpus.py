@@ -0,0 +1,395 @@
+#corpus.py
+import os
+import json
+import hashlib
+import itertools
+import numpy as np
+from tqdm import tqdm
+
+
+ROWS = ("user_id","item_id","review","rating")
+
+# A columnar corpus is a directory holding one flat binary file per column:
+#   - tokens:           token ids of every word, reviews and sentences concatenated   [n_tokens]
+#   - sent_offsets:     start of each sentence in tokens (+ end of the last one)      [n_sents+1]
+#   - review_offsets:   start of each review in sent_offsets (+ end of the last one)  [n_reviews+1]
+#   - user, item:       ids in users.json/items.json                                  [n_reviews]
+#   - rating, split:                                                                  [n_reviews]
+#   - aspects:          extra rating fields (rows after ROWS, i.e beer aspects) of each review, row major  [n_reviews*n_aspects]
+# Token ids index vocab.json. Column sizes are kept in meta.json.
+COLUMNS = (("tokens",np.int32),("sent_offsets",np.int64),("review_offsets",np.int64),("user",np.int32),("item",np.int32),("rating",np.float32),("split",np.int8),("aspects",np.float32))
+
+
+def is_corpus(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path,"meta.json"))
+
+
+class CorpusWriter():
+    """
+    Writes (user,item,review,rating) tuples to a columnar corpus directory, chunk by chunk.
+    Has the same write(data,splits)/close() interface as prepare_data.ShardWriter, close() returns the Corpus.
+    If a vocab {word:id} is given, reviews are expected to be already mapped to its ids.
+    With path=None, columns are kept in memory as numpy arrays (see Corpus.from_tuples).
+    With append=True, an existing corpus at path is extended: vocab/users/items ids are kept and
+    columns are appended to (after being truncated to meta.json sizes, in case a former append died midway).
+    nb_splits is recorded in meta.json, None if unknown.
+    """
+
+    def __init__(self,path,rows=ROWS,vocab=None,append=False,nb_splits=None):
+        self.path = path
+        self.rows = rows
+        self.mapped = vocab is not None
+        self.vocab = vocab if self.mapped else {}
+        self.users = {}
+        self.items = {}
+        self.sizes = {name:0 for name,_ in COLUMNS}
+        self.nb_splits = nb_splits
+        self.n_sents = 0
+        self.n_tokens = 0
+
+        if path is None:
+            self.chunks = {name:[] for name,_ in COLUMNS}
+        elif append:
+            self._reopen()
+            return
+        else:
+            os.makedirs(path,exist_ok=True)
+            self.files = {name:open(os.path.join(path,name+".bin"),"wb") for name,_ in COLUMNS}
+
+        self._append("sent_offsets",[0])
+        self._append("review_offsets",[0])
+
+    def _reopen(self):
+        with open(os.path.join(self.path,"meta.json")) as f:
+            meta = json.load(f)
+
+        self.rows = tuple(meta["rows"])
+        self.sizes = {name:meta["sizes"].get(name,0) for name,_ in COLUMNS}
+        self.nb_splits = meta.get("nb_splits",self.nb_splits)
+        self.n_sents = self.sizes["sent_offsets"]-1
+        self.n_tokens = self.sizes["tokens"]
+
+        for name in ("vocab","users","items"):
+            with open(os.path.join(self.path,name+".json")) as f:
+                setattr(self,name,{k:i for i,k in enumerate(json.load(f)) if k is not None})
+
+        self.files = {}
+        for name,dtype in COLUMNS:
+            fn = os.path.join(self.path,name+".bin")
+            f = open(fn,"r+b" if os.path.exists(fn) else "w+b")
+            f.truncate(self.sizes[name]*np.dtype(dtype).itemsize)
+            f.seek(0,os.SEEK_END)
+            self.files[name] = f
+
+    def _append(self,name,values):
+        arr = np.asarray(values,dtype=dict(COLUMNS)[name])
+        if self.path is None:
+            self.chunks[name].append(arr)
+        else:
+            arr.tofile(self.files[name])
+        self.sizes[name] += len(arr)
+
+    def write(self,data,splits):
+        w_id = self.vocab.setdefault
+        tokens,sent_ends,review_ends,users,items,ratings,aspects = [],[],[],[],[],[],[]
+
+        for user,item,review,rating,*aspect in data:
+            for sent in review:
+                tokens.extend(sent if self.mapped else (w_id(w,len(self.vocab)) for w in sent))
+                sent_ends.append(self.n_tokens+len(tokens))
+            review_ends.append(self.n_sents+len(sent_ends))
+            users.append(self.users.setdefault(user,len(self.users)))
+            items.append(self.items.setdefault(item,len(self.items)))
+            ratings.append(rating)
+            aspects.extend(aspect)
+
+        self._append("tokens",tokens)
+        self._append("sent_offsets",sent_ends)
+        self._append("review_offsets",review_ends)
+        self._append("user",users)
+        self._append("item",items)
+        self._append("rating",ratings)
+        self._append("split",splits)
+        self._append("aspects",aspects)
+        self.n_tokens += len(tokens)
+        self.n_sents += len(sent_ends)
+
+    def write_flat(self,tokens,sent_offsets,review_offsets,users,items,ratings,aspects,splits):
+        """
+        write() of reviews already mapped and flattened (see Data.flatten_reviews), with users/items already ids:
+        columns are appended as is, without any per-token python work (see Data.prebuild).
+        """
+        self._append("tokens",tokens)
+        self._append("sent_offsets",np.asarray(sent_offsets[1:])+self.n_tokens)
+        self._append("review_offsets",np.asarray(review_offsets[1:])+self.n_sents)
+        self._append("user",users)
+        self._append("item",items)
+        self._append("rating",ratings)
+        self._append("split",splits)
+        self._append("aspects",np.ravel(aspects))
+        self.n_tokens += len(tokens)
+        self.n_sents += len(sent_offsets)-1
+
+    @staticmethod
+    def _id2key(d):
+        id2k = [None] * (max(d.values())+1 if len(d) > 0 else 0)
+        for k,i in d.items():
+            id2k[i] = k
+        return id2k
+
+    def close(self):
+        if self.path is None:
+            columns = {name:np.concatenate(chunks) for name,chunks in self.chunks.items()}
+            return Corpus(columns=columns,rows=self.rows,vocab=self._id2key(self.vocab))
+
+        for f in self.files.values():
+            f.close()
+
+        for name,d in (("vocab",self.vocab),("users",self.users),("items",self.items)):
+            with open(os.path.join(self.path,name+".json"),"w") as f:
+                json.dump(self._id2key(d),f)
+
+        with open(os.path.join(self.path,"meta.json"),"w") as f:
+            json.dump({"rows":self.rows,"sizes":self.sizes,"nb_splits":self.nb_splits},f)
+
+        return Corpus(self.path)
+
+
+class Corpus():
+    """
+    Read-only view on a columnar corpus, every column is a numpy.memmap.
+    Nothing is loaded upfront and forked DataLoader workers share the same pages.
+    Indexing yields (user,item,review,rating) tuples where review is a list of token id arrays (one per sentence).
+
+    In-memory corpora (columns given as arrays) hold no per-review python object either:
+    workers never write to the array pages, so copy-on-write keeps them shared.
+    """
+
+    def __init__(self,path=None,columns=None,rows=ROWS,vocab=None):
+        self.path = path
+
+        if path is None:
+            self.rows = tuple(rows)
+            self.vocab = vocab
+            for name,dtype in COLUMNS:
+                setattr(self,name,columns[name] if name in columns or name != "aspects" else np.zeros(0,dtype=dtype)) # no aspect rows: aspects may be left out
+            self.aspects = self.aspects.reshape(len(self),len(self.rows)-len(ROWS))
+            return
+
+        with open(os.path.join(path,"meta.json")) as f:
+            meta = json.load(f)
+
+        self.rows = tuple(meta["rows"])
+
+        for name,dtype in COLUMNS:
+            size = meta["sizes"].get(name,0)
+            if size > 0:
+                col = np.memmap(os.path.join(path,name+".bin"),dtype=dtype,mode="r",shape=(size,))
+            else:
+                col = np.zeros(0,dtype=dtype) #can't memmap an empty file
+            setattr(self,name,col)
+
+        self.aspects = self.aspects.reshape(len(self),len(self.rows)-len(ROWS))
+
+        with open(os.path.join(path,"vocab.json")) as f:
+            self.vocab = json.load(f)
+
+    @staticmethod
+    def from_tuples(data,splits,rows=ROWS,chunk_size=10000):
+        """
+        Packs a (user,item,review,rating) tuple list in an in-memory Corpus.
+        """
+        writer = CorpusWriter(None,rows)
+        for start in tqdm(range(0,len(data),chunk_size),desc="Packing tuples in arrays"):
+            writer.write(data[start:start+chunk_size],splits[start:start+chunk_size])
+        return writer.close()
+
+    def __len__(self):
+        return len(self.review_offsets)-1
+
+    def __getitem__(self,index):
+        return (self.user[index].item(),self.item[index].item(),self.review(index),self.rating[index].item()) + tuple(self.aspects[index].tolist())
+
+    def column(self,field):
+        """
+        Scalar column of a tuple field, None if the field isn't one (review)
+        """
+        if field >= len(ROWS):
+            return self.aspects[:,field-len(ROWS)]
+        return {0:self.user,1:self.item,3:self.rating}.get(field)
+
+    def review(self,index):
+        s_start,s_end = self.review_offsets[index],self.review_offsets[index+1]
+        offsets = self.sent_offsets[s_start:s_end+1]
+        words = self.tokens[offsets[0]:offsets[-1]]
+        return np.split(words,offsets[1:-1]-offsets[0])
+
+    def lengths(self,idxs=None,max_sents=-1,max_words=-1):
+        """
+        (nb sentences, longest sentence, nb tokens) of each review, after trimming
+        """
+        sent_lens = np.diff(self.sent_offsets)
+        rev_lens = np.diff(self.review_offsets)
+        starts = self.review_offsets[:-1]
+
+        if max_words > 0:
+            sent_lens = np.minimum(sent_lens,max_words)
+        if max_sents > 0:
+            pos = np.arange(len(sent_lens)) - np.repeat(starts,rev_lens)
+            sent_lens = np.where(pos < max_sents,sent_lens,0)
+            rev_lens = np.minimum(rev_lens,max_sents)
+
+        cumsum = np.concatenate([[0],np.cumsum(sent_lens)])
+        nb_tokens = cumsum[self.review_offsets[1:]] - cumsum[starts]
+        longest = np.maximum.reduceat(np.append(sent_lens,0),starts) if len(starts) > 0 else np.zeros(0,dtype=np.int64)
+        longest[rev_lens == 0] = 0
+
+        if idxs is not None:
+            idxs = np.asarray(idxs,dtype=np.int64)
+            return rev_lens[idxs],longest[idxs],nb_tokens[idxs]
+        return rev_lens,longest,nb_tokens
+
+    def token_mask(self,idxs):
+        """
+        Boolean mask over tokens selecting the reviews in idxs
+        """
+        mask = np.zeros(len(self),dtype=bool)
+        mask[np.asarray(idxs,dtype=np.int64)] = True
+        sents_per_rev = np.diff(self.review_offsets)
+        words_per_sent = np.diff(self.sent_offsets)
+        return np.repeat(np.repeat(mask,sents_per_rev),words_per_sent)
+
+    def word_counts(self,idxs=None,key=None):
+        """
+        (word,count) list of the reviews in idxs (all if None), by decreasing count then word (as vocab.count_words).
+        key normalizes words before counting (i.e str.lower), the same key must be given to lookup_table.
+        """
+        tokens = self.tokens if idxs is None else self.tokens[self.token_mask(idxs)]
+        counts = np.bincount(tokens,minlength=len(self.vocab))
+
+        if key is not None:
+            merged = {}
+            for w,c in zip(self.vocab,counts.tolist()):
+                if c > 0:
+                    k = key(w)
+                    merged[k] = merged.get(k,0) + c
+            return sorted(merged.items(),key=lambda x:(-x[1],x[0]))
+
+        nonzero = np.flatnonzero(counts)
+        return sorted(zip([self.vocab[i] for i in nonzero.tolist()],counts[nonzero].tolist()),key=lambda x:(-x[1],x[0]))
+
+    def word_dict(self,idxs=None,offset=0,max_count=-1,key=None):
+        """
+        Vocabulary of the reviews in idxs (all if None), by decreasing count (see word_counts).
+        """
+        words = self.word_counts(idxs,key)
+
+        if max_count > -1:
+            words = words[:max_count]
+
+        return {w:i for i,(w,_) in enumerate(words,offset)}
+
+    def lookup_table(self,word_dict,unk=1,key=None):
+        """
+        Array mapping corpus token ids to word_dict ids (unk if absent).
+        """
+        if key is None:
+            key = lambda w:w
+        return np.array([word_dict.get(key(w),unk) for w in self.vocab],dtype=np.int64)
+
+
+class ReviewMapper():
+    """
+    FMTL mapping for Corpus reviews: maps token ids with a lookup table and trims reviews (max_sents) and sentences (max_words)
+    """
+
+    def __init__(self,table,max_sents=-1,max_words=-1):
+        self.table = table
+        self.max_sents = max_sents
+        self.max_words = max_words
+
+    def __call__(self,review):
+        return self.map_batch([review])[0]
+
+    def map_batch(self,reviews):
+        """
+        Maps a batch of reviews with a single table lookup
+        """
+        if self.max_sents > 0:
+            reviews = [r[:self.max_sents] for r in reviews]
+        sents = [s for r in reviews for s in r]
+        if self.max_words > 0:
+            sents = [s[:self.max_words] for s in sents]
+
+        if len(sents) == 0:
+            return [[] for _ in reviews]
+
+        words = np.concatenate(sents)
+        if self.table is not None:
+            words = self.table[words]
+        words = words.tolist()
+
+        offsets = [0] + list(itertools.accumulate(map(len,sents)))
+        sents = [words[a:b] for a,b in zip(offsets,offsets[1:])]
+        offsets = [0] + list(itertools.accumulate(map(len,reviews)))
+        return [sents[a:b] for a,b in zip(offsets,offsets[1:])]
+
+
+def fingerprint(path):
+    """
+    sha1 of a file's content. Columnar corpora are fingerprinted by their json files, split and rating columns
+    (small, and rewritten when splits or labels change) and the size and mtime of every other column.
+    """
+    h = hashlib.sha1()
+
+    if is_corpus(path):
+        files = sorted(os.path.join(path,f) for f in os.listdir(path) if f.endswith(".json"))
+        columns = [os.path.join(path,name+".bin") for name,_ in COLUMNS]
+        columns = [fn for fn in columns if os.path.exists(fn)] # corpora written before aspects have no aspects.bin
+        files += [fn for fn in columns if os.path.basename(fn) in ("split.bin","rating.bin","aspects.bin")]
+        for fn in columns:
+            st = os.stat(fn)
+            h.update("{} {} {}".format(os.path.basename(fn),st.st_size,st.st_mtime_ns).encode("utf-8"))
+    else:
+        files = [path]
+
+    for fn in files:
+        with open(fn,"rb") as f:
+            for chunk in iter(lambda: f.read(1<<20),b""):
+                h.update(chunk)
+
+    return h.hexdigest()
+
+
+def cache_key(*parts):
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def save_vectorized(path,fmtl,splits,wdict,chunk_size=10000):
+    """
+    Caches a FMTL's mapped reviews as a columnar corpus whose vocabulary is wdict.
+    user/item/rating are kept raw, their mappings are cheap to rebuild from the columns.
+    """
+    tmp = path+".tmp"
+    r_field = fmtl._f2i("review")
+    writer = CorpusWriter(tmp,tuple(sorted(fmtl.rows,key=fmtl.rows.get)),vocab=wdict)
+
+    for start in tqdm(range(0,len(fmtl),chunk_size),desc="Caching vectorized corpus"):
+        idxs = range(start,min(start+chunk_size,len(fmtl)))
+        data = []
+        for i in idxs:
+            t = fmtl.tuplelist[i]
+            data.append(t[:r_field] + (fmtl[i][r_field],) + t[r_field+1:])
+        writer.write(data,[splits[i] for i in idxs])
+
+    writer.close()
+    os.rename(tmp,path)
+
+
+def load_vectorized(path):
+    """
+    Opens a corpus written by save_vectorized, returns it along with its word dict
+    """
+    corpus = Corpus(path)
+    wdict = {w:i for i,w in enumerate(corpus.vocab) if w is not None}
+    return corpus,wdict
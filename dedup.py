@@ -0,0 +1,78 @@
+#dedup.py
+import re
+import math
+import hashlib
+import numpy as np
+
+
+_NON_WORD = re.compile(r"\W+")
+
+
+def normalize(text):
+    """
+    Review text as compared for duplicates: lower case, punctuation and spacing removed
+    """
+    return _NON_WORD.sub(" ",text.lower()).strip()
+
+
+class Deduplicator():
+    """
+    Streaming duplicate filter on (user,item,normalized text), used by prepare_data.py and beer2json.py.
+    Keys are hashed in a Bloom filter: memory is fixed by capacity and error_rate (~29 bits/review at 1e-6),
+    whatever the stream length. error_rate is the odds of dropping a unique review, as long as at most
+    capacity reviews are seen.
+    """
+
+    def __init__(self,capacity=10000000,error_rate=1e-6):
+        self.nb_bits = int(math.ceil(-capacity*math.log(error_rate)/math.log(2)**2))
+        self.nb_hashes = max(1,int(round(self.nb_bits/capacity*math.log(2))))
+        self.bits = np.zeros((self.nb_bits+7)//8,dtype=np.uint8)
+        self.capacity = capacity
+        self.seen = 0
+        self.removed = 0
+
+    @staticmethod
+    def key(user,item,text):
+        return hashlib.blake2b("{}\t{}\t{}".format(user,item,normalize(text)).encode("utf-8"),digest_size=16).digest()
+
+    def _positions(self,keys):
+        h = np.frombuffer(b"".join(keys),dtype=np.uint64).reshape(-1,2)
+        i = np.arange(self.nb_hashes,dtype=np.uint64)
+        return (h[:,:1] + i*h[:,1:]) % np.uint64(self.nb_bits) # double hashing, [n_keys,nb_hashes]
+
+    def duplicates(self,keys):
+        """
+        Boolean mask of the keys already seen (before or earlier in keys), adds the others to the filter
+        """
+        dupes = np.zeros(len(keys),dtype=bool)
+        first = {}
+        for j,k in enumerate(keys):
+            if first.setdefault(k,j) != j:
+                dupes[j] = True
+
+        new = np.flatnonzero(~dupes)
+        if len(new) > 0:
+            pos = self._positions([keys[j] for j in new])
+            set_bits = (self.bits[pos >> np.uint64(3)] >> (pos & np.uint64(7)).astype(np.uint8)) & 1
+            dupes[new[set_bits.all(axis=1)]] = True
+            pos = pos[~set_bits.all(axis=1)].ravel()
+            np.bitwise_or.at(self.bits,pos >> np.uint64(3),np.left_shift(1,pos & np.uint64(7)).astype(np.uint8))
+
+        self.seen += len(keys)
+        self.removed += int(dupes.sum())
+        return dupes
+
+    def filter(self,records,key):
+        """
+        records without duplicates, key(record) -> (user,item,text)
+        """
+        if len(records) == 0:
+            return records
+        dupes = self.duplicates([self.key(*key(r)) for r in records])
+        return [r for r,d in zip(records,dupes) if not d]
+
+    def report(self):
+        msg = "Removed {} duplicates out of {} reviews".format(self.removed,self.seen)
+        if self.seen - self.removed > self.capacity:
+            msg += " (over the filter's capacity of {}, raise it to keep the error rate)".format(self.capacity)
+        return msg
@@ -0,0 +1,126 @@
+#export.py
+import argparse
+import json
+import time
+import random
+import torch
+
+from Nets import HAN, NSCUPA, HANInference, NSCUPAInference
+
+# TorchScript export of models saved by han.py/nscupa.py (see Nets.HANInference) and its latency against eager mode.
+# Exported files only need torch: torch.jit.load(path,_extra_files={"word_dic.json":"","meta.json":""})
+
+
+def load_net(path):
+    """
+    (net, word_dic) of a han.py/nscupa.py saved model, in eval mode. NSCUPA models are told apart by their users embedding
+    """
+    state = torch.load(path,map_location="cpu")
+    wdict = state.pop("word_dic")
+    aspect_classes = [state["aspect_outs.{}.weight".format(k)].size(0) for k in range(sum(1 for k in state if k.startswith("aspect_outs.") and k.endswith(".weight")))]
+    sizes = dict(ntoken=state["embed.weight"].size(0),emb_size=state["embed.weight"].size(1),hid_size=state["sent.lin.weight"].size(1)//2,
+                 num_class=state["lin_out.weight"].size(0),aspect_classes=aspect_classes)
+
+    if "users.weight" in state:
+        net = NSCUPA(nusers=state["users.weight"].size(0),nitems=state["items.weight"].size(0),encoder=state.pop("encoder","lstm"),**sizes)
+    else:
+        net = HAN(encoder=state.pop("encoder","gru"),**sizes)
+
+    net.labels = state.pop("labels",None) # models saved before labels were kept have none
+    net.load_state_dict(state)
+    return net.eval(),wdict
+
+
+def script(net):
+    return torch.jit.script(NSCUPAInference(net) if isinstance(net,NSCUPA) else HANInference(net))
+
+
+def export(args):
+    """
+    Compiles a saved model to a standalone TorchScript file, word dict, class labels and input description attached
+    """
+    net,wdict = load_net(args.model)
+    scripted = script(net)
+
+    inputs = ["tokens","sent_offsets","review_offsets"] + (["users","items"] if isinstance(net,NSCUPA) else [])
+    meta = {"model":"nscupa" if isinstance(net,NSCUPA) else "han","encoder":net.encoder,"inputs":inputs,
+            "outputs":["overall"] + (list(net.labels["aspects"]) if net.labels else ["aspect_{}".format(k) for k in range(len(net.aspect_outs))]),
+            "unknown_word":1,"labels":net.labels}
+    if net.labels is None:
+        print("WARNING: {} holds no class labels (saved by an older han.py/nscupa.py), outputs are class indexes only".format(args.model))
+
+    torch.jit.save(scripted,args.output,_extra_files={"word_dic.json":json.dumps(wdict),"meta.json":json.dumps(meta)})
+    print("==> {} ({} encoder) exported to {}, inputs: {}".format(meta["model"],net.encoder,args.output,", ".join(inputs)))
+
+
+def bench(args):
+    """
+    Latency per batch of the eager model (collate + forward) and of its TorchScript export (flat reviews), on random reviews
+    """
+    from Data import review_batch, flatten_reviews
+
+    torch.set_grad_enabled(False)
+    net,wdict = load_net(args.model)
+    scripted = torch.jit.load(args.scripted) if args.scripted else script(net)
+    is_nscupa = isinstance(net,NSCUPA)
+    rand = random.Random(1337)
+
+    print("{:>8} {:>12} {:>12} {:>8} {:>10}".format("b_size","eager ms","script ms","speedup","max diff"))
+    for b_size in args.b_sizes:
+        reviews = [[[rand.randrange(2,net.embed.num_embeddings) for _ in range(rand.randint(1,args.max_words))] for _ in range(rand.randint(1,args.max_sents))] for _ in range(b_size)]
+        users = torch.LongTensor([rand.randrange(net.users.num_embeddings) if is_nscupa else 0 for _ in range(b_size)])
+        items = torch.LongTensor([rand.randrange(net.items.num_embeddings) if is_nscupa else 0 for _ in range(b_size)])
+
+        def eager():
+            batch_t,sent_order,ls,lr,r_perm,ui_indexs = review_batch(reviews)
+            r_perm = torch.LongTensor(r_perm)
+            if is_nscupa:
+                return net(batch_t,users[r_perm],items[r_perm],sent_order,ui_indexs,ls,lr),r_perm
+            return net(batch_t,sent_order,ls,lr),r_perm
+
+        def compiled():
+            flat = [torch.from_numpy(x).long() for x in flatten_reviews(reviews)]
+            return scripted(*flat,users,items) if is_nscupa else scripted(*flat)
+
+        out,r_perm = eager()
+        out = out[0] if isinstance(out,(list,tuple)) else out
+        diff = (out - compiled()[0][r_perm]).abs().max().item()
+
+        times = []
+        for f in (eager,compiled):
+            for _ in range(args.warmup):
+                f()
+            start = time.time()
+            for _ in range(args.repeat):
+                f()
+            times.append((time.time()-start)/args.repeat*1000)
+
+        print("{:>8} {:>12.2f} {:>12.2f} {:>7.2f}x {:>10.1e}".format(b_size,times[0],times[1],times[0]/times[1],diff))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="TorchScript export of han.py/nscupa.py models")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    p = subparsers.add_parser("export",help=export.__doc__)
+    p.add_argument("model",type=str,help="model saved by han.py/nscupa.py (--save)")
+    p.add_argument("output",type=str,help="TorchScript file")
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser("bench",help=bench.__doc__)
+    p.add_argument("model",type=str,help="model saved by han.py/nscupa.py (--save)")
+    p.add_argument("--scripted",type=str,help="exported file to time (the model is scripted on the fly if not given)")
+    p.add_argument("--b-sizes",type=int,nargs="+",default=[1,8,32,128])
+    p.add_argument("--max-sents",type=int,default=15)
+    p.add_argument("--max-words",type=int,default=40)
+    p.add_argument("--warmup",type=int,default=3)
+    p.add_argument("--repeat",type=int,default=20)
+    p.add_argument("--threads",type=int,help="torch threads")
+    p.set_defaults(func=bench)
+
+    args = parser.parse_args()
+    if getattr(args,"threads",None):
+        torch.set_num_threads(args.threads)
+    args.func(args)
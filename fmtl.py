@@ -1,8 +1,136 @@
 from collections import Counter
 import itertools
+import numpy as np
 import spacy
 
 
+_MISSING = object()
+
+
+class DictMapper():
+    """
+    Compiled dict mapping: maps a whole field value (scalar, list or list of lists) - or a batch of them - in one lookup.
+    - dicts with small non-negative int keys/values are compiled to a numpy lookup table
+    - other dicts are looked up with a single map(dict.get) over all flattened atoms
+    Missing keys are mapped to unk, or raise a KeyError if unk is None (same as FMTL._rec_apply).
+    key normalizes atoms before lookup (i.e str.lower) and trim gives max lengths per nesting level (i.e (max_sents,max_words)).
+    The table is recompiled when the dict's size changes only: call refresh() after changing values in place.
+    """
+
+    def __init__(self,mapping,unk=None,key=None,trim=None):
+        self.mapping = mapping
+        self.unk = unk
+        self.key = key
+        self.trim = trim
+        self._size = -1
+
+    def _compile(self):
+        self._size = len(self.mapping)
+        self.table = None
+
+        if self.key is not None or self._size == 0:
+            return
+
+        if not all(type(k) is int and type(v) is int for k,v in self.mapping.items()):
+            return
+
+        keys = np.fromiter(self.mapping.keys(),dtype=np.int64,count=self._size)
+        if keys.min() < 0 or keys.max() >= 4*self._size+1024: #too sparse for a table
+            return
+
+        self.table = np.zeros(keys.max()+1,dtype=np.int64)
+        self.known = np.zeros(keys.max()+1,dtype=bool)
+        self.table[keys] = np.fromiter(self.mapping.values(),dtype=np.int64,count=self._size)
+        self.known[keys] = True
+
+    def refresh(self):
+        self._compile()
+
+    def _missing(self,value):
+        raise KeyError("No mapping or placeholder for value: {}".format(value))
+
+    def _lookup(self,flat,size):
+        if self.table is not None:
+            if len(flat) > 0 and isinstance(flat[0],np.ndarray):
+                ids = np.concatenate(flat).astype(np.int64)
+            else:
+                ids = np.fromiter(itertools.chain.from_iterable(flat),dtype=np.int64,count=size)
+
+            clipped = np.clip(ids,0,len(self.table)-1)
+            out = self.table[clipped]
+            known = self.known[clipped] & (ids == clipped)
+
+            if not known.all():
+                if self.unk is None:
+                    self._missing(ids[~known][0])
+                out[~known] = self.unk
+
+            return out.tolist()
+
+        atoms = itertools.chain.from_iterable(flat)
+        if self.key is not None:
+            atoms = map(self.key,atoms)
+        out = list(map(self.mapping.get,atoms,itertools.repeat(_MISSING)))
+
+        if _MISSING in out:
+            if self.unk is None:
+                self._missing(next(a for a,o in zip(itertools.chain.from_iterable(flat),out) if o is _MISSING))
+            out = [self.unk if o is _MISSING else o for o in out]
+
+        return out
+
+    @staticmethod
+    def _depth(value):
+        if not isinstance(value,(list,tuple,np.ndarray)):
+            return 0
+        if len(value) > 0 and isinstance(value[0],(list,tuple,np.ndarray)):
+            return 2
+        return 1
+
+    @staticmethod
+    def _split(flat,lengths):
+        offsets = [0] + list(itertools.accumulate(lengths))
+        return [flat[a:b] for a,b in zip(offsets,offsets[1:])]
+
+    def __call__(self,value):
+        return self.map_batch([value])[0]
+
+    def map_batch(self,values):
+        """
+        Maps a list of field values with a single lookup over all their atoms
+        """
+        if len(self.mapping) != self._size: # the dict changed (or was never compiled)
+            self._compile()
+
+        if len(values) == 0:
+            return []
+
+        depth = self._depth(values[0])
+        if any(self._depth(v) != depth for v in values):
+            return [self(v) for v in values]
+
+        if depth == 0:
+            return self._lookup([values],len(values))
+
+        if depth == 2:
+            if self.trim is not None:
+                values = [v[:self.trim[0]] for v in values]
+            lengths = list(map(len,values))
+            values = list(itertools.chain.from_iterable(values))
+
+        if self.trim is not None:
+            values = [v[:self.trim[-1]] for v in values]
+
+        s_lengths = list(map(len,values))
+        mapped = self._split(self._lookup(values,sum(s_lengths)),s_lengths)
+
+        if depth == 2:
+            mapped = self._split(mapped,lengths)
+
+        return mapped
+
+
+
 class FMTL_iterator():		
     """
     Simple indexed iterator on FMTL
@@ -14,6 +142,12 @@ class FMTL_iterator():
     def __getitem__(self, i):
         return self.fmtl[self.idxs[i]]
 
+    def __getitems__(self, idxs):
+        """
+        Batch fetch, called by DataLoader (torch >= 2.0) with a whole batch of indexes instead of one __getitem__ per sample.
+        """
+        return self.fmtl.get_batch([self.idxs[i] for i in idxs])
+
     def __len__(self):
         return len(self.idxs)
 
@@ -45,6 +179,7 @@ class FMTL():
         self.tuplelist = tuplelist
         self.mappings = {}
         self.unknown = {}
+        self.compiled = {}
         #self.rows = rows
        
     def __len__(self):
@@ -56,7 +191,7 @@ class FMTL():
             -> if field is a tuple/list maps each element inside, keeping structure
             -> else directly maps
             -> if mapping function return error, tries to map with 'unk' value.
-            (see self._rec_apply)
+            (see DictMapper, self._rec_apply for spacy docs)
         """
         if len(self.mappings) == 0:
             return self.tuplelist[index]
@@ -65,7 +200,10 @@ class FMTL():
 
             for i,m in self.mappings.items():
                 if type(m) is dict:
-                    t[i] = self._rec_apply(m.__getitem__,t[i],self.unknown.get(i))
+                    if isinstance(t[i], spacy.tokens.doc.Doc):
+                        t[i] = self._rec_apply(m.__getitem__,t[i],self.unknown.get(i))
+                    else:
+                        t[i] = self.compiled[i](t[i])
                 else:
                     try:
                         t[i] = m(t[i])
@@ -77,6 +215,34 @@ class FMTL():
 
             return tuple(t)
 
+    def get_batch(self,indexes):
+        """
+        Batched __getitem__: each mapped field is mapped for the whole batch at once (see DictMapper.map_batch).
+        Falls back to per-tuple __getitem__ on mapping errors or spacy docs, to keep the same unknown semantics.
+        """
+        batch = [self.tuplelist[i] for i in indexes]
+
+        if len(self.mappings) == 0 or len(batch) == 0:
+            return batch
+
+        fields = [list(f) for f in zip(*batch)]
+
+        for i,m in self.mappings.items():
+            if type(m) is dict:
+                if isinstance(fields[i][0], spacy.tokens.doc.Doc):
+                    return [self[idx] for idx in indexes]
+                m = self.compiled[i]
+
+            try:
+                if hasattr(m,"map_batch"):
+                    fields[i] = m.map_batch(fields[i])
+                else:
+                    fields[i] = [m(x) for x in fields[i]]
+            except:
+                return [self[idx] for idx in indexes]
+
+        return list(zip(*fields))
+
     def __iter__(self):
         self.iter_idxs = range(len(self.tuplelist)).__iter__()
         return self
@@ -129,6 +295,9 @@ class FMTL():
         if unk is not None:
             self.unknown[field] = unk
 
+        if type(mapping) is dict:
+            self.compiled[field] = DictMapper(mapping,self.unknown.get(field))
+
         return mapping
 
     def field_gen(self, field, key_iter=None):
@@ -137,8 +306,20 @@ class FMTL():
         if key_iter is None:
             key_iter = range(len(self))
 
-        for idx in key_iter:
-            yield self[idx][field]
+        column = self.tuplelist.column(field) if hasattr(self.tuplelist,"column") else None
+
+        if column is not None: # columnar storage: no need to build whole tuples
+            m = self.mappings.get(field)
+            for x in column[list(key_iter)].tolist():
+                if m is None:
+                    yield x
+                elif type(m) is dict:
+                    yield self.compiled[field](x)
+                else:
+                    yield m(x)
+        else:
+            for idx in key_iter:
+                yield self[idx][field]
         
 
     def indexed_iter(self,idxs):
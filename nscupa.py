@@ -2,6 +2,7 @@ import argparse
 import pickle as pkl
 from tqdm import tqdm
 import math
+import time
 
 import torch
 import torch.nn as nn
@@ -9,49 +10,34 @@ import torch.optim as optim
 from torch.autograd import Variable
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
-from Nets import NSCUPA, HAN
-from fmtl import FMTL
+from Nets import NSCUPA, HAN, ENCODERS
+from fmtl import FMTL, DictMapper
+from Data import review_batch, review_lengths, BucketBatchSampler, TokenBudgetBatchSampler
+from corpus import Corpus, ReviewMapper, is_corpus, load_vectorized, save_vectorized
 from utils import *
+from vocab import build_vocab
+import gc
 
 
 def save(net, dic, path):
     dict_m = net.state_dict()
     dict_m["word_dic"] = dic    
+    dict_m["encoder"] = net.encoder
+    dict_m["labels"] = net.labels
     torch.save(dict_m,path)
 
 def tuple_batch(l):
-    user, item, review,rating = zip(*l)
-    r_t = torch.Tensor(rating).long()
-    u_t = torch.Tensor(user).long()
-    i_t = torch.Tensor(item).long()
-    list_rev = review
-
-    sorted_r = sorted([(len(r),r_n,r) for r_n,r in enumerate(list_rev) ],reverse=True) #index by desc rev_le
-    lr, r_n, ordered_list_rev = zip(*sorted_r)
-    
-    lr = list(lr)
+    user, item, review = list(zip(*l))[:3]
+    batch_t,sent_order,ls,lr,r_n,ui_indexs = review_batch(review)
 
-    max_sents = lr[0]
     #reordered
-    r_t = r_t[[r_n]]
-    u_t = u_t[[r_n]]
-    i_t = i_t[[r_n]]
+    r_t = torch.Tensor([x[3:] for x in l]).long()[r_n] # [number_of_reviews, 1 + number_of_aspects]
+    if r_t.size(1) == 1:
+        r_t = r_t.squeeze(1)
+    u_t = torch.Tensor(user).long()[r_n]
+    i_t = torch.Tensor(item).long()[r_n]
     review = [review[x] for x in r_n] #reorder reviews
 
-    stat =  sorted([(len(s), r_n, s_n, s) for r_n, r in enumerate(ordered_list_rev) for s_n, s in enumerate(r)], reverse=True)
-    max_words = stat[0][0]
-
-    ls = []
-    batch_t = torch.zeros(len(stat), max_words).long()                          # (sents ordered by len)
-    ui_indexs = torch.zeros(len(stat)).long()                                  # (sents original rev_n)
-    sent_order = torch.zeros(len(ordered_list_rev), max_sents).long().fill_(0) # (rev_n,sent_n)
-
-    for i,s in enumerate(stat):
-        sent_order[s[1],s[2]] = i+1
-        ui_indexs[i]=s[1]
-        batch_t[i,0:len(s[3])] = torch.LongTensor(s[3])
-        ls.append(s[0])
-
     return batch_t,r_t,u_t,i_t,sent_order,ui_indexs,ls,lr,review
 
 
@@ -67,6 +53,10 @@ def train(epoch,net,dataset,device,msg="val/test",optimize=False,optimizer=None,
     mean_mse = 0
     mean_rmse = 0
     ok_all = 0
+    ok_aspects = None
+    nb_reviews = 0
+    nb_batches = 0
+    start = time.time()
     #data_tensors = new_tensors(3,cuda,types={0:torch.LongTensor,1:torch.LongTensor,2:torch.LongTensor}) #data-tensors
 
     with tqdm(total=len(dataset),desc=msg) as pbar:
@@ -80,24 +70,34 @@ def train(epoch,net,dataset,device,msg="val/test",optimize=False,optimizer=None,
 
            
             out = net(data[0],data[2],data[3],data[4],data[5],ls,lr)
+            outs,targets = output_heads(out,data[1])
 
-            ok,per,val_i = accuracy(out,data[1])
+            ok,per,val_i = accuracy(outs[0],targets[0])
             ok_all += per.item()
 
-            mseloss = F.mse_loss(val_i,data[1].float())
+            if len(outs) > 1: # aspects accuracy
+                ok_aspects = [0]*(len(outs)-1) if ok_aspects is None else ok_aspects
+                for k,(o,t) in enumerate(zip(outs[1:],targets[1:])):
+                    ok_aspects[k] += accuracy(o,t)[1].item()
+
+            mseloss = F.mse_loss(val_i,targets[0].float())
             mean_rmse += math.sqrt(mseloss.item())
             mean_mse += mseloss.item()
 
             if optimize:
-                loss =  criterion(out, data[1]) 
+                loss = sum(criterion(o,t) for o,t in zip(outs,targets))
                 epoch_loss += loss.item()
                 loss.backward()
                 optimizer.step()
 
+            nb_reviews += len(lr)
+            nb_batches += 1
             pbar.update(1)
             pbar.set_postfix({"acc":ok_all/(iteration+1),"CE":epoch_loss/(iteration+1),"mseloss":mean_mse/(iteration+1),"rmseloss":mean_rmse/(iteration+1)})
 
-    print("===> Epoch {} Complete: Avg. Loss: {:.4f}, {}% accuracy".format(epoch, epoch_loss /len(dataset),ok_all/len(dataset)))
+    print("===> Epoch {} Complete: Avg. Loss: {:.4f}, {}% accuracy, {:.1f} reviews/s ({} encoder)".format(epoch, epoch_loss/max(nb_batches,1),ok_all/max(nb_batches,1),nb_reviews/(time.time()-start),net.encoder))
+    if ok_aspects is not None:
+        print("     Aspects accuracy: " + ", ".join("{:.2f}%".format(ok/nb_batches) for ok in ok_aspects))
 
 
 def test(epoch,net,dataset,cuda,msg="Evaluating"):
@@ -128,12 +128,37 @@ def test(epoch,net,dataset,cuda,msg="Evaluating"):
 
 def load(args):
 
-    datadict = pkl.load(open(args.filename,"rb"))
-    data_tl,(trainit,valit,testit) = FMTL_train_val_test(datadict["data"],datadict["splits"],args.split,validation=0.5,rows=datadict["rows"])
+    cache = vectorized_cache(args,"nscupa")
+    cached = cache is not None and is_corpus(cache)
+
+    if cached:
+        print("==> Loading vectorized corpus from {}".format(cache))
+        corpus,wdict = load_vectorized(cache)
+    elif is_corpus(args.filename):
+        corpus = Corpus(args.filename)
+    elif args.storage == "arrays":
+        datadict = load_datadict(args.filename)
+        corpus = Corpus.from_tuples(datadict["data"],datadict["splits"],datadict["rows"])
+        del datadict
+    else:
+        corpus = None
+        datadict = load_datadict(args.filename)
+
+    if corpus is not None:
+        splits = corpus.split
+        data_tl,(trainit,valit,testit) = FMTL_train_val_test(corpus,splits,args.split,validation=0.5,rows=corpus.rows)
+    else:
+        splits = datadict["splits"]
+        data_tl,(trainit,valit,testit) = FMTL_train_val_test(datadict["data"],splits,args.split,validation=0.5,rows=datadict["rows"])
 
     rating_mapping = data_tl.get_field_dict("rating",key_iter=trainit) #creates class mapping
     data_tl.set_mapping("rating",rating_mapping) 
 
+    aspect_mappings = set_aspect_mappings(data_tl,trainit) # extra output heads
+    aspect_classes = [len(m) for m in aspect_mappings]
+    if len(aspect_classes) > 0:
+        print("==> Multi-aspect ratings: overall + {}".format(", ".join(aspect_fields(data_tl))))
+
     user_mapping = data_tl.get_field_dict("user_id",key_iter=trainit,offset=1) #creates class mapping
     data_tl.set_mapping("user_id",user_mapping,unk=0) # if unknown #id is 0
     user_mapping["_unk_"] = 0
@@ -147,37 +172,48 @@ def load(args):
         wdict = state["word_dic"]
     else:
         if args.emb:
-            tensor,wdict = load_embeddings(args.emb,offset=2)
-        else:     
-            wdict = data_tl.get_field_dict("review",key_iter=trainit,offset=2, max_count=args.max_feat, iter_func=(lambda x: (w for s in x for w in s )))
+            tensor,wdict = load_embeddings(args.emb,offset=2,vocab=corpus_words(data_tl) if args.emb_restrict else None,cache_dir=args.cache_dir)
+        elif cached:
+            pass # comes with the cache
+        else:
+            wdict = build_vocab(args,data_tl,trainit,"nscupa")
 
         wdict["_pad_"] = 0
         wdict["_unk_"] = 1
     
-    if args.max_words > 0 and args.max_sents > 0:
+    if cached:
+        data_tl.set_mapping("review",ReviewMapper(None))
+    elif corpus is not None:
+        data_tl.set_mapping("review",ReviewMapper(corpus.lookup_table(wdict,unk=1),args.max_sents,args.max_words))
+    elif args.max_words > 0 and args.max_sents > 0:
         print("==> Limiting review and sentence length: ({} sents of {} words) ".format(args.max_sents,args.max_words))
-        data_tl.set_mapping("review",(lambda f:[[wdict.get(w[:args.max_words],1) for w in s[:args.max_sents]] for s in f]))
+        data_tl.set_mapping("review",DictMapper(wdict,unk=1,trim=(args.max_sents,args.max_words)))
     else:
         data_tl.set_mapping("review",wdict,unk=1)
 
+    if cache is not None and not cached:
+        save_vectorized(cache,data_tl,splits,wdict)
+
     print("Train set class stats:\n" + 10*"-")
     _,_ = data_tl.get_stats("rating",trainit,True)
 
     if args.load:
-        net = NSCUPA(ntoken=len(state["word_dic"]),nusers=state["users.weight"].size(0), nitems=state["items.weight"].size(0),emb_size=state["embed.weight"].size(1),hid_size=state["sent.rnn.weight_hh_l0"].size(1),num_class=state["lin_out.weight"].size(0))
+        net = NSCUPA(ntoken=len(state["word_dic"]),nusers=state["users.weight"].size(0), nitems=state["items.weight"].size(0),emb_size=state["embed.weight"].size(1),hid_size=state["sent.lin.weight"].size(1)//2,num_class=state["lin_out.weight"].size(0),aspect_classes=[state["aspect_outs.{}.weight".format(k)].size(0) for k in range(len(aspect_classes))],encoder=state.pop("encoder","lstm"))
         del state["word_dic"]
+        state.pop("labels",None)
         net.load_state_dict(state)
 
     else:
         if args.emb:
-            net = NSCUPA(ntoken=len(wdict),nusers=len(user_mapping), nitems=len(item_mapping),emb_size=len(tensor[1]),hid_size=args.hid_size,num_class=len(rating_mapping))
+            net = NSCUPA(ntoken=len(wdict),nusers=len(user_mapping), nitems=len(item_mapping),emb_size=len(tensor[1]),hid_size=args.hid_size,num_class=len(rating_mapping),aspect_classes=aspect_classes,encoder=args.encoder)
             net.set_emb_tensor(torch.FloatTensor(tensor))
         else:
-            net = NSCUPA(ntoken=len(wdict),nusers=len(user_mapping), nitems=len(item_mapping), emb_size=args.emb_size,hid_size=args.hid_size, num_class=len(rating_mapping))
+            net = NSCUPA(ntoken=len(wdict),nusers=len(user_mapping), nitems=len(item_mapping), emb_size=args.emb_size,hid_size=args.hid_size, num_class=len(rating_mapping),aspect_classes=aspect_classes,encoder=args.encoder)
 
     if args.prebuild:
-        data_tl = FMTL(list(x for x  in tqdm(data_tl,desc="prebuilding")),data_tl.rows)
+        data_tl = prebuild(data_tl,wdict,splits,workers=args.prebuild_workers)
 
+    net.labels = output_labels(data_tl,rating_mapping,aspect_mappings) # saved along (see save)
     return data_tl,(trainit,valit,testit), net, wdict
 
 
@@ -187,7 +223,18 @@ def main(args):
     data_tl, (train_set, val_set, test_set), net, wdict = load(args)
 
 
-    dataloader = DataLoader(data_tl.indexed_iter(train_set), batch_size=args.b_size, shuffle=True, num_workers=3, collate_fn=tuple_batch,pin_memory=True)
+    if hasattr(gc,"freeze"): # python >= 3.7, keeps gc passes in forked workers from copying every object
+        gc.freeze()
+
+    if args.max_tokens_per_batch > 0:
+        sampler = TokenBudgetBatchSampler(review_lengths(data_tl,train_set,args.max_sents,args.max_words),args.max_tokens_per_batch,args.max_sents_per_batch,pool_size=args.b_size*(args.bucket or 50))
+        dataloader = DataLoader(data_tl.indexed_iter(train_set), batch_sampler=sampler, num_workers=3, collate_fn=tuple_batch,pin_memory=True)
+    elif args.bucket > 0:
+        sampler = BucketBatchSampler(review_lengths(data_tl,train_set,args.max_sents,args.max_words),args.b_size,bucket_size=args.bucket)
+        dataloader = DataLoader(data_tl.indexed_iter(train_set), batch_sampler=sampler, num_workers=3, collate_fn=tuple_batch,pin_memory=True)
+    else:
+        sampler = None
+        dataloader = DataLoader(data_tl.indexed_iter(train_set), batch_size=args.b_size, shuffle=True, num_workers=3, collate_fn=tuple_batch,pin_memory=True)
     dataloader_valid = DataLoader(data_tl.indexed_iter(val_set), batch_size=args.b_size, shuffle=False,  num_workers=3, collate_fn=tuple_batch)
     dataloader_test = DataLoader(data_tl.indexed_iter(test_set), batch_size=args.b_size, shuffle=False, num_workers=3, collate_fn=tuple_batch,drop_last=True)
 
@@ -207,6 +254,10 @@ def main(args):
         print("\n-------EPOCH {}-------".format(epoch))
         train(epoch,net,dataloader,device,msg="training",optimize=True,optimizer=optimizer,criterion=criterion)
 
+        if sampler is not None:
+            bucketed,shuffled = sampler.padding_efficiency()
+            print("Padding efficiency: {:.1%} of word cells are real ({:.1%} with shuffled batches), {:.1%} of sentence cells ({:.1%})".format(bucketed["words"],shuffled["words"],bucketed["sentences"],shuffled["sentences"]))
+
         if args.snapshot:
             print("snapshot of model saved as {}".format(args.save+"_snapshot"))
             save(net,wdict,args.save+"_snapshot")
@@ -225,15 +276,22 @@ if __name__ == '__main__':
     
     parser.add_argument("--emb-size",type=int,default=200)
     parser.add_argument("--hid-size",type=int,default=100)
+    parser.add_argument("--encoder", choices=sorted(ENCODERS), default="lstm", help="sequence encoder of both levels: gru/lstm, cnn (convolutions) or qrnn (lightweight recurrence), faster on CPU")
 
     parser.add_argument("--max-feat", type=int,default=10000)
+    parser.add_argument("--vocab-workers", type=int, default=0, help="processes counting words of tuples storage by shards (0: in process)")
+    parser.add_argument("--vocab-approx", type=int, default=0, help="approximate word counts keeping the N most common words (count-min sketch), bounds memory on huge vocabularies (0: exact)")
     parser.add_argument("--epochs", type=int,default=10)
     parser.add_argument("--clip-grad", type=float,default=1)
     parser.add_argument("--lr", type=float, default=0.01)
     parser.add_argument("--momentum",type=float,default=0.9)
     parser.add_argument("--b-size", type=int, default=32)
+    parser.add_argument("--bucket", type=int, default=0, help="batches reviews of similar lengths, bucketing pools of --bucket batches (0: plain shuffling)")
+    parser.add_argument("--max-tokens-per-batch", type=int, default=0, help="packs training batches up to this many padded words (sentences x longest sentence) instead of --b-size reviews (0: off)")
+    parser.add_argument("--max-sents-per-batch", type=int, default=0, help="caps the sentences of --max-tokens-per-batch batches (0: no cap)")
 
     parser.add_argument("--emb", type=str)
+    parser.add_argument("--emb-restrict", action="store_true", help="only keeps the pretrained embeddings of words found in the dataset")
     parser.add_argument("--max-words", type=int,default=-1)
     parser.add_argument("--max-sents",type=int,default=-1)
 
@@ -241,7 +299,10 @@ if __name__ == '__main__':
     parser.add_argument("--load", type=str)
     parser.add_argument("--save", type=str)
     parser.add_argument("--snapshot", action='store_true')
-    parser.add_argument("--prebuild",action="store_true")
+    parser.add_argument("--prebuild",action="store_true", help="maps the whole dataset once, into numpy arrays")
+    parser.add_argument("--prebuild-workers", type=int, default=0, help="processes mapping --prebuild chunks (0: in process)")
+    parser.add_argument("--storage", choices=["arrays","tuples"], default="arrays", help="pickled data is packed in numpy arrays (shared by DataLoader workers) or kept as python tuples")
+    parser.add_argument("--cache-dir", type=str, help="caches the vectorized corpus (and parsed --emb embeddings) there, reused by runs with the same data/vocabulary/trimming/split")
     parser.add_argument('--cuda', action='store_true', help='use CUDA')
 
     parser.add_argument("--output", type=str)
@@ -3,26 +3,54 @@ import argparse
 import logging
 import json
 import pickle as pkl
-import spacy
 import itertools
+import time
+import os
+import re
+import hashlib
 
 from tqdm import tqdm
 from random import randint,shuffle
-from collections import Counter
+from collections import Counter, deque
+from multiprocessing import Pool
+from corpus import CorpusWriter, ROWS, is_corpus
+from dedup import Deduplicator
 
 
-def count_lines(file):
-    count = 0
-    for _ in file:
-        count += 1
-    file.seek(0)
-    return count
+def data_batches(data,batch_size=10000):
+    """
+    Single pass over a gzip json file, yields lists of records: batch_size lines are parsed with a single json.loads.
+    Progress is measured on compressed bytes read, so the file isn't decompressed twice to count lines.
+    """
+    with open(data,"rb") as raw, gzip.GzipFile(fileobj=raw) as f, tqdm(total=os.path.getsize(data),desc="Reading",unit="B",unit_scale=True) as pbar:
+        while True:
+            lines = list(itertools.islice(f,batch_size))
+            pbar.update(raw.tell()-pbar.n)
+            if len(lines) == 0:
+                return
+            lines = [l for l in lines if l.strip()]
+            if len(lines) > 0:
+                yield json.loads(b"[" + b",".join(lines) + b"]")
 
 
 def data_generator(data):
-    with gzip.open(args.input,"r") as f:
-        for x in tqdm(f,desc="Reviews",total=count_lines(f)):
-            yield json.loads(x)
+    return itertools.chain.from_iterable(data_batches(data))
+
+
+def review_batches(args,batch_size=10000):
+    """
+    data_batches of args.input, without duplicate reviews if args.dedup (see dedup.py)
+    """
+    dedup = Deduplicator(args.dedup_capacity) if args.dedup else None
+
+    for batch in data_batches(args.input,batch_size):
+        if dedup is not None:
+            batch = dedup.filter(batch,key=lambda z:(z["reviewerID"],z["asin"],z["reviewText"]))
+        if len(batch) > 0:
+            yield batch
+
+    if dedup is not None:
+        print(dedup.report())
 
 
 def to_array_comp(doc):
@@ -33,19 +61,174 @@ def custom_pipeline(nlp):
     return (nlp.tagger, nlp.parser,to_array_comp)
 
 
+def to_sents(tok):
+    """
+    nlp.pipe can hand back the Doc rather than to_array_comp's output, normalize to list(list(str))
+    """
+    if isinstance(tok,list):
+        return tok
+    return to_array_comp(tok)
+
+
+class SpacyTokenizer():
+    """
+    spaCy backend: sentences come from the dependency parse (tagger + parser), slow but accurate.
+    """
+
+    def __init__(self):
+        import spacy
+        self.nlp = spacy.load('en', create_pipeline=custom_pipeline)
+
+    def pipe(self,texts,batch_size=1000,n_threads=1):
+        return (to_sents(tok) for tok in self.nlp.pipe(texts, batch_size=batch_size, n_threads=n_threads))
+
+
+class RuleTokenizer():
+    """
+    Rule based backend, regular expressions only (no tagger nor parser):
+    - sentences end on . ! ? (and closing quotes/brackets) followed by a capitalized word, a digit or a new line,
+      except after common abbreviations and initials
+    - tokens are split roughly like spaCy: words, numbers, punctuation and clitics (do|n't, it|'s)
+    """
+
+    SENT_END = re.compile(r"(?:(?<=[.!?])|(?<=[.!?][\"')\]]))\s+(?=[\"'(\[]?[A-Z0-9])|\s*\n\s*")
+    ABBREV = re.compile(r"(?:\b(?:mr|mrs|ms|dr|prof|sr|jr|st|vs|etc|approx|no|vol|inc|ltd|co)|\b(?-i:[A-HJ-Z])|\b(?:[A-Za-z]\.){1,3}[A-Za-z])\.$",re.IGNORECASE)
+    TOKEN = re.compile(r"(?i)[a-z]+(?=n't\b)|n't\b|'(?:s|m|d|re|ve|ll)\b|\w+(?:[-.,/]\w+)*|\.\.+|[^\w\s]")
+
+    def split(self,text):
+        sents = []
+        for piece in self.SENT_END.split(text):
+            if len(sents) > 0 and self.ABBREV.search(sents[-1]):
+                sents[-1] += " " + piece
+            elif piece:
+                sents.append(piece)
+        return [toks for toks in map(self.TOKEN.findall,sents) if toks]
+
+    def pipe(self,texts,batch_size=1000,n_threads=1):
+        return map(self.split,texts)
+
+
+TOKENIZERS = {"spacy":SpacyTokenizer,"rules":RuleTokenizer}
+
+
+class ShardWriter():
+    """
+    Writes (user,item,review,rating) tuples shard by shard, each shard being a standalone pickle.
+    On close, an index pickle listing the shards is written at the output path (see utils.load_datadict).
+    With append=True, new shards are added to an existing index. A plain (single pickle) output is first turned into
+    an index whose first shard holds its reviews.
+    """
+
+    def __init__(self,output,rows=ROWS,append=False,nb_splits=None):
+        self.output = output
+        self.shard_dir = output+"_shards"
+        self.rows = rows
+        self.shards = []
+        self.nb_splits = nb_splits
+
+        os.makedirs(self.shard_dir,exist_ok=True)
+
+        if append:
+            index = pkl.load(open(output,"rb"))
+            self.rows = tuple(index["rows"])
+
+            if "shards" in index:
+                self.shards = index["shards"]
+                self.nb_splits = index.get("nb_splits",nb_splits)
+            else: # plain pickle, its reviews become the first shard (the index is written on close)
+                print("-> {} isn't sharded, its {} reviews are moved to {}".format(output,len(index["data"]),self.shard_dir))
+                self.write(index["data"],index["splits"])
+                if len(index["splits"]) > 0 and max(index["splits"]) >= (nb_splits or 0):
+                    self.nb_splits = max(index["splits"])+1 # checked against --nb_splits by open_writer
+
+    def write(self,data,splits):
+        name = os.path.join(os.path.basename(self.shard_dir),"shard_{:06d}.pkl".format(len(self.shards)))
+        with open(os.path.join(os.path.dirname(self.output),name),"wb") as f:
+            pkl.dump({"data":data,"splits":splits,"rows":self.rows},f)
+        self.shards.append(name)
+
+    def close(self):
+        with open(self.output,"wb") as f:
+            pkl.dump({"shards":self.shards,"rows":self.rows,"nb_splits":self.nb_splits},f)
+
+
+def hash_split(user,item,nb_splits):
+    """
+    Deterministic split of a review from its (reviewer,asin): the same review always lands in the same split
+    """
+    h = hashlib.md5("{}\t{}".format(user,item).encode("utf-8")).digest()
+    return int.from_bytes(h[:8],"little") % nb_splits
+
+
+def make_splits(data,args):
+    if args.splits == "hash":
+        return [hash_split(x[0],x[1],args.nb_splits) for x in data]
+    return [randint(0,args.nb_splits-1) for _ in range(0,len(data))]
+
+
+def output_rows(args):
+    return ROWS + tuple(args.aspects)
+
+
+def open_writer(args):
+    """
+    Output writer of the streaming/append modes, checks that appended data uses the same number of splits and rows
+    """
+    rows = output_rows(args)
+
+    if args.format == "columnar":
+        writer = CorpusWriter(args.output,rows,append=args.append,nb_splits=args.nb_splits)
+    else:
+        writer = ShardWriter(args.output,rows,append=args.append,nb_splits=args.nb_splits)
+
+    if tuple(writer.rows) != rows:
+        raise ValueError("{} has rows {}, not {} (--aspects)".format(args.output,tuple(writer.rows),rows))
+
+    if writer.nb_splits is not None and writer.nb_splits != args.nb_splits:
+        raise ValueError("{} has {} splits, not {} (--nb_splits)".format(args.output,writer.nb_splits,args.nb_splits))
+
+    return writer
+
+
+_tokenizer = None
+
+def _init_tokenizer(name):
+    global _tokenizer
+    _tokenizer = TOKENIZERS[name]()
+
+
+def to_tuple(z,tok,aspects=()):
+    """
+    (user,item,review,rating) tuple of a json record, followed by its aspect ratings if any
+    """
+    return (z["reviewerID"],z["asin"],tok,z["overall"]) + tuple(float(z["aspects"][a]) for a in aspects)
+
+
+def tokenize_chunk(chunk,aspects=()):
+    """
+    Pool task: tokenizes a chunk of json records to (user,item,review,rating,*aspects) tuples.
+    Also returns the worker pid and the time spent for throughput stats.
+    """
+    start = time.time()
+    docs = _tokenizer.pipe((z["reviewText"] for z in chunk), batch_size=1000, n_threads=1)
+    data = [to_tuple(z,tok,aspects) for z,tok in zip(chunk,docs)]
+    return os.getpid(),time.time()-start,data
+
+
 def build_dataset(args):
 
     print("Building dataset from : {}".format(args.input))
-    print("-> Building {} random splits".format(args.nb_splits))
+    print("-> Building {} {} splits".format(args.nb_splits,args.splits))
 
-    nlp = spacy.load('en', create_pipeline=custom_pipeline)
-    gen_a,gen_b = itertools.tee(data_generator(args.input),2)
-    data = [(z["reviewerID"],z["asin"],tok,z["overall"]) for z,tok in zip(tqdm((z for z in gen_a),desc="reading file"),nlp.pipe((x["reviewText"] for x in gen_b), batch_size=1000000, n_threads=8))]
+    tokenizer = TOKENIZERS[args.tokenizer]()
+    data = []
+    for batch in review_batches(args):
+        data.extend(to_tuple(z,tok,args.aspects) for z,tok in zip(batch,tokenizer.pipe((x["reviewText"] for x in batch), batch_size=len(batch), n_threads=8)))
 
     print(data[0])
     shuffle(data)
 
-    splits = [randint(0,args.nb_splits-1) for _ in range(0,len(data))]
+    splits = make_splits(data,args)
     count = Counter(splits)
 
     print("Split distribution is the following:")
@@ -55,13 +238,64 @@ def build_dataset(args):
     #    for word in sent:
     #        print(word)
 
-    return {"data":data,"splits":splits,"rows":("user_id","item_id","review","rating")}
+    return {"data":data,"splits":splits,"rows":output_rows(args)}
+
+
+def build_dataset_streaming(args):
+    """
+    Shards the input across a pool of tokenizers, each tokenized chunk is written to disk as it arrives.
+    At most 2*workers chunks are in flight so memory is bounded by the shard size, not the corpus size.
+    """
+    print("Building dataset from : {}".format(args.input))
+    print("-> Streaming {} reviews shards over {} tokenizer processes".format(args.shard_size,args.workers))
+    print("-> Building {} {} splits".format(args.nb_splits,args.splits))
+
+    writer = open_writer(args)
+    count = Counter()
+    w_stats = {} # pid -> [nb_reviews,seconds]
+    pending = deque()
+
+    def collect(res):
+        pid,elapsed,data = res
+        shuffle(data)
+        splits = make_splits(data,args)
+        count.update(splits)
+        writer.write(data,splits)
+
+        stat = w_stats.setdefault(pid,[0,0.])
+        stat[0] += len(data)
+        stat[1] += elapsed
+        pbar.update(len(data))
+        pbar.set_postfix({"rev/s/worker":sum(n for n,_ in w_stats.values())/max(sum(t for _,t in w_stats.values()),1e-6)})
+
+    start = time.time()
+    with Pool(args.workers,initializer=_init_tokenizer,initargs=(args.tokenizer,)) as pool, tqdm(desc="Tokenized reviews") as pbar:
+        for chunk in review_batches(args,args.shard_size):
+            pending.append(pool.apply_async(tokenize_chunk,(chunk,args.aspects)))
+            while len(pending) >= 2*args.workers:
+                collect(pending.popleft().get())
+
+        while len(pending) > 0:
+            collect(pending.popleft().get())
+
+    writer.close()
+    elapsed = time.time()-start
+
+    print("Tokenizer throughput:")
+    for pid,(n,t) in sorted(w_stats.items()):
+        print("  worker {}: {} reviews, {:.1f} reviews/sec".format(pid,n,n/max(t,1e-6)))
+    print("  total: {} reviews in {:.1f}s, {:.1f} reviews/sec".format(sum(count.values()),elapsed,sum(count.values())/max(elapsed,1e-6)))
+
+    print("Split distribution is the following:")
+    print(count)
+
 
 def build_dataset_debug(args):
 
     print("Building dataset from : {}".format(args.input))
     print("-> Building {} random splits".format(args.nb_splits))
 
+    import spacy
     nlp = spacy.load('en', create_pipeline=custom_pipeline)
     #nlp = spacy.load('en')
     #gen_a,gen_b = itertools.tee(data_generator(args.input),2)
@@ -86,8 +320,30 @@ def build_dataset_debug(args):
     #return {"data":data,"splits":splits,"rows":("user_id","item_id","review","rating")}
 
 def main(args):
-    ds = build_dataset(args)
-    pkl.dump(ds,open(args.output,"wb"))
+    if args.append:
+        args.splits = "hash"
+        args.append = os.path.exists(args.output) # appending to nothing creates the dataset
+        if args.append:
+            print("-> Appending to {}, new reviews get hash splits".format(args.output))
+            if args.dedup:
+                print("-> --dedup only drops duplicates within the input, not of the reviews already in {}".format(args.output))
+            args.format = "columnar" if is_corpus(args.output) else "pickle"
+
+    if args.workers > 0:
+        build_dataset_streaming(args)
+    else:
+        ds = build_dataset(args)
+
+        if args.append:
+            writer = open_writer(args)
+            writer.write(ds["data"],ds["splits"])
+            writer.close()
+        elif args.format == "columnar":
+            writer = CorpusWriter(args.output,ds["rows"],nb_splits=args.nb_splits)
+            writer.write(ds["data"],ds["splits"])
+            writer.close()
+        else:
+            pkl.dump(ds,open(args.output,"wb"))
     #build_dataset_debug(args)
 
 if __name__ == '__main__':
@@ -96,6 +352,15 @@ if __name__ == '__main__':
     parser.add_argument("input", type=str)
     parser.add_argument("output", type=str, default="sentences.pkl")
     parser.add_argument("--nb_splits",type=int, default=5)
+    parser.add_argument("--splits",choices=["random","hash"], default="random", help="hash: split from a hash of (reviewer,asin), stable across runs")
+    parser.add_argument("--dedup",action="store_true", help="drops reviews with the same user, item and normalized text")
+    parser.add_argument("--dedup-capacity",type=int, default=10000000, help="reviews the dedup filter is sized for (its memory is fixed, ~4 bytes/review)")
+    parser.add_argument("--append",action="store_true", help="adds the input's reviews to an existing output (columnar or pickle, which gets sharded), with hash splits")
+    parser.add_argument("--workers",type=int, default=0, help="tokenizer processes, > 0 streams the output shard by shard")
+    parser.add_argument("--format",choices=["pickle","columnar"], default="pickle", help="columnar writes a memory-mappable corpus directory (see corpus.py)")
+    parser.add_argument("--tokenizer",choices=sorted(TOKENIZERS), default="spacy", help="spacy: full tagger + parser, rules: fast regex sentence splitter/tokenizer")
+    parser.add_argument("--aspects",nargs="+", default=[], help="keeps these aspect ratings of the records' \"aspects\" (see beer2json.py --aspects), as extra rating rows")
+    parser.add_argument("--shard-size",type=int, default=20000, help="reviews per shard in streaming mode")
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -0,0 +1,81 @@
+#test_workers.py
+# DataLoader worker memory of array-backed vs tuple list corpora (collected by pytest, Linux only: reads /proc).
+
+
+def _private_mem():
+    """
+    Private (unshared) memory of the current process in kB. A forked worker's RSS already counts
+    the pages it shares with its parent, copy-on-write copies only show up here.
+    """
+    with open("/proc/self/smaps_rollup") as f:
+        return sum(int(l.split()[1]) for l in f if l.startswith("Private_"))
+
+
+def _worker_mem_growth(storage,queue,nb_reviews=200000,num_workers=3):
+    """
+    Max private memory growth of DataLoader workers over an epoch, on 5x10 words synthetic reviews.
+    Runs in a fresh (spawned) interpreter so the forked workers only inherit the dataset.
+    """
+    import gc
+    import numpy as np
+    import torch
+    from torch.utils.data import DataLoader
+    from corpus import Corpus, ReviewMapper
+    from fmtl import FMTL
+
+    rows = ("user_id","item_id","review","rating")
+    vocab = ["w{}".format(i) for i in range(1000)]
+    wdict = {w:i for i,w in enumerate(vocab,2)}
+    tokens = np.random.RandomState(0).randint(0,len(vocab),size=nb_reviews*50).astype(np.int32)
+
+    if storage == "arrays":
+        columns = {"tokens":tokens,"sent_offsets":np.arange(0,len(tokens)+1,10),"review_offsets":np.arange(0,nb_reviews*5+1,5),
+                   "user":np.zeros(nb_reviews,dtype=np.int32),"item":np.zeros(nb_reviews,dtype=np.int32),
+                   "rating":np.full(nb_reviews,5,dtype=np.float32),"split":np.zeros(nb_reviews,dtype=np.int8)}
+        corpus = Corpus(columns=columns,rows=rows,vocab=vocab)
+        fmtl = FMTL(corpus,rows)
+        fmtl.set_mapping("review",ReviewMapper(corpus.lookup_table(wdict)))
+    else:
+        words = [vocab[w] for w in tokens.tolist()]
+        data = [("u","i",[words[s:s+10] for s in range(r,r+50,10)],5.0) for r in range(0,len(words),50)]
+        del words
+        fmtl = FMTL(data,rows)
+        fmtl.set_mapping("review",wdict,unk=1)
+
+    del tokens
+
+    def init(_):
+        torch.utils.data.get_worker_info().dataset.mem_start = _private_mem()
+
+    def collate(l):
+        it = torch.utils.data.get_worker_info().dataset
+        return _private_mem() - it.mem_start
+
+    gc.freeze() # gc passes in the workers would copy every object, not only the dataset
+    it = fmtl.indexed_iter(range(len(fmtl)))
+    loader = DataLoader(it,batch_size=256,num_workers=num_workers,collate_fn=collate,worker_init_fn=init,multiprocessing_context="fork")
+    queue.put(max(loader))
+
+
+def test_worker_rss():
+    """
+    Iterating an epoch in forked DataLoader workers copies a tuple list corpus (refcounts, gc) but not an array-backed one.
+    """
+    import queue as q
+    from multiprocessing import get_context
+
+    ctx = get_context("spawn")
+    growth = {}
+    for storage in ("arrays","tuples"):
+        queue = ctx.Queue()
+        p = ctx.Process(target=_worker_mem_growth,args=(storage,queue))
+        p.start()
+        while storage not in growth:
+            try:
+                growth[storage] = queue.get(timeout=5)
+            except q.Empty:
+                assert p.is_alive(), "{} storage probe exited with code {}".format(storage,p.exitcode)
+        p.join()
+
+    print("worker private memory growth: tuples {tuples} kB, arrays {arrays} kB".format(**growth))
+    assert growth["arrays"] < growth["tuples"] / 4
@@ -1,13 +1,20 @@
 #utils.py
+import os
+import json
+import itertools
+import pickle as pkl
+import numpy as np
 import torch
 from tqdm import tqdm
 from torch.autograd import Variable
 from fmtl import FMTL
+from corpus import CorpusWriter, ReviewMapper, fingerprint, cache_key
+from Data import flatten_reviews, pool_map
 
 
 def tuple2var(tensors,data):
     def copy2tensor(t,data):
-        t.resize_(data.size()).copy_(data,async=True)
+        t.resize_(data.size()).copy_(data,non_blocking=True)
         return Variable(t)
     return tuple(map(copy2tensor,tensors,data))
 
@@ -21,6 +28,47 @@ def new_tensors(n,cuda,types={}):
         return x
     return tuple([new_tensor(types.setdefault(i,None),cuda) for i in range(0,n)])
 
+def aspect_fields(fmtl):
+    """
+    Rating fields after the (user,item,review,rating) ones, i.e beer aspects (see corpus.COLUMNS)
+    """
+    return sorted(fmtl.rows,key=fmtl.rows.get)[4:]
+
+
+def set_aspect_mappings(fmtl,key_iter):
+    """
+    Maps each aspect field to classes, like rating. Returns their class mappings, in aspect_fields order.
+    """
+    mappings = []
+    for field in aspect_fields(fmtl):
+        mapping = fmtl.get_field_dict(field,key_iter=key_iter)
+        fmtl.set_mapping(field,mapping)
+        mappings.append(mapping)
+    return mappings
+
+
+def output_labels(fmtl,rating_mapping,aspect_mappings):
+    """
+    Label of each output class, {"rating":[...], "aspects":{field:[...]}}: saved with models to turn predictions back into ratings
+    """
+    def labels(mapping):
+        out = [None]*len(mapping)
+        for label,i in mapping.items():
+            out[i] = label.item() if hasattr(label,"item") else label # numpy scalars of columnar corpora
+        return out
+
+    return {"rating":labels(rating_mapping),"aspects":{f:labels(m) for f,m in zip(aspect_fields(fmtl),aspect_mappings)}}
+
+
+def output_heads(out,r_t):
+    """
+    (logits,targets) lists over the model's output heads: [overall] or [overall,aspect_1,...] (see Nets.HAN._output)
+    """
+    if isinstance(out,list):
+        return out,[r_t[:,k] for k in range(len(out))]
+    return [out],[r_t]
+
+
 def accuracy(out,truth):
     def sm(mat):
         exp = torch.exp(mat)
@@ -39,39 +87,183 @@ def checkpoint(epoch,net,output):
     torch.save(net, model_out_path)
     print("Checkpoint saved to {}".format(model_out_path))
 
-def load_embeddings(file,offset=0):
-    emb_file = open(file).readlines()
-    first = emb_file[0]
-    word, vec = int(first.split()[0]),int(first.split()[1])
-    size = (word,vec)
-    print("--> Got {} words of {} dimensions".format(size[0],size[1]))
-    tensor = torch.zeros(size[0]+offset,size[1]) ## adding offset
-    word_d = {}
+def parse_embeddings(file,chunk_size=100000):
+    """
+    Parses a word2vec text file chunk by chunk into a float32 array [nb_words, dim] (in file order)
+    and the list of its words (None for malformed lines, whose row stays zero).
+    """
+    with open(file,encoding="utf-8",errors="ignore") as f:
+        first = f.readline()
+        size = (int(first.split()[0]),int(first.split()[1]))
+        print("--> Got {} words of {} dimensions".format(size[0],size[1]))
+        print("skipping embedding size line:\'{}\'".format(first.strip()))
 
-    print("--> Shape with padding and unk_token:")
-    print(tensor.size())
+        matrix = np.zeros(size,dtype=np.float32)
+        words = []
 
-    for i,line in tqdm(enumerate(emb_file),desc="Creating embedding tensor",total=len(emb_file)):
-        if i==0: #skipping header (-1 to the enumeration to take it into account)
-            print("skipping embedding size line:\'{}\'".format(line.strip()))
-            continue
+        with tqdm(total=size[0],desc="Parsing embeddings") as pbar:
+            for lines in iter(lambda: list(itertools.islice(f,chunk_size)),[]):
+                start = len(words)
+                rows,vecs = [],[]
 
-        spl = line.strip().split(" ")
+                for j,line in enumerate(lines,start):
+                    word,_,vec = line.strip().partition(" ")
+                    if vec.count(" ") == size[1]-1: #word is most probably whitespace or junk if badly parsed
+                        words.append(word)
+                        rows.append(j)
+                        vecs.append(vec)
+                    else:
+                        words.append(None)
+                        print("WARNING: MALFORMED EMBEDDING DICTIONNARY:\n {} \n line isn't parsed correctly".format(line))
 
-        if len(spl[1:]) == size[1]: #word is most probably whitespace or junk if badly parsed
-            word_d[spl[0]] = i + offset-1
-            tensor[i+offset-1] = torch.FloatTensor(list(float(x) for x in spl[1:]))
-        else:
-            print("WARNING: MALFORMED EMBEDDING DICTIONNARY:\n {} \n line isn't parsed correctly".format(line))
+                if len(rows) > 0:
+                    matrix[rows] = np.fromstring(" ".join(vecs),dtype=np.float32,sep=" ").reshape(len(rows),size[1])
+                pbar.update(len(lines))
 
-    try:
-        assert(len(word_d)==size[0])
-    except:
+    if len(words) != size[0] or None in words:
         print("Final dictionnary length differs from number of embeddings - some lines were malformed.")
 
+    return matrix[:len(words)],words
+
+
+def load_embeddings(file,offset=0,vocab=None,cache_dir=None):
+    """
+    Loads word2vec text embeddings as a [nb_words+offset, dim] tensor (the first offset rows are zeros) and a {word:row} dict.
+    - vocab: set of words, only their rows are kept (the rest of a big pretrained file is never used)
+    - cache_dir: the parsed file is cached there as .npy + words .json, later runs memory-map it instead of parsing
+    """
+    matrix = None
+
+    if cache_dir:
+        st = os.stat(file)
+        name = os.path.join(cache_dir,"emb_{}".format(cache_key(os.path.abspath(file),st.st_size,st.st_mtime)))
+        if os.path.exists(name+".json"):
+            print("--> Loading cached embeddings from {}.npy".format(name))
+            matrix = np.load(name+".npy",mmap_mode="r")
+            with open(name+".json") as f:
+                words = json.load(f)
+
+    if matrix is None:
+        matrix,words = parse_embeddings(file)
+        if cache_dir:
+            os.makedirs(cache_dir,exist_ok=True)
+            np.save(name+".npy",matrix)
+            with open(name+".json","w") as f: # written last, marks the cache complete
+                json.dump(words,f)
+
+    if vocab is not None:
+        rows = [i for i,w in enumerate(words) if w is not None and w in vocab]
+        print("--> Keeping the {} embeddings of the {} corpus words".format(len(rows),len(vocab)))
+    else:
+        rows = list(range(len(words)))
+
+    tensor = torch.zeros(len(rows)+offset,matrix.shape[1]) ## adding offset
+    tensor[offset:] = torch.from_numpy(np.ascontiguousarray(matrix[rows]))
+    word_d = {words[i]:j for j,i in enumerate(rows,offset) if words[i] is not None}
+
+    print("--> Shape with padding and unk_token:")
+    print(tensor.size())
+
     return tensor, word_d
 
 
+def corpus_words(data_tl,key=None):
+    """
+    Words of the whole dataset (normalized by key, i.e str.lower), see load_embeddings' vocab
+    """
+    if hasattr(data_tl.tuplelist,"vocab"):
+        words = (w for w in data_tl.tuplelist.vocab if w is not None)
+    else:
+        r_field = data_tl._f2i("review")
+        words = (w for t in tqdm(data_tl.tuplelist,desc="Corpus words") for s in t[r_field] for w in s)
+
+    if key is not None:
+        words = map(key,words)
+
+    return set(words)
+
+
+
+def load_datadict(path):
+    """
+    Loads a prepare_data.py pickle. Streamed datasets (prepare_data.py --workers) are an index of shards
+    which are concatenated back to the usual {"data","splits","rows"} dict.
+    """
+    datadict = pkl.load(open(path,"rb"))
+
+    if "shards" in datadict:
+        data,splits = [],[]
+        root = os.path.dirname(path)
+
+        for shard in tqdm(datadict["shards"],desc="Loading shards"):
+            s = pkl.load(open(os.path.join(root,shard),"rb"))
+            data.extend(s["data"])
+            splits.extend(s["splits"])
+
+        datadict = {"data":data,"splits":splits,"rows":datadict["rows"]}
+
+    return datadict
+
+
+
+def vectorized_cache(args,model):
+    """
+    Path of the vectorized corpus cache for these arguments, None if --cache-dir isn't set.
+    Keyed on the input file, the vocabulary source (saved model, embeddings or --max-feat and --vocab-approx), trimming and split.
+    """
+    if not args.cache_dir:
+        return None
+
+    if args.load:
+        vocab = fingerprint(args.load)
+    elif args.emb:
+        vocab = [fingerprint(args.emb),args.emb_restrict]
+    else:
+        vocab = [args.max_feat,args.vocab_approx]
+
+    key = cache_key(model,fingerprint(args.filename),vocab,args.max_words,args.max_sents,args.split)
+    os.makedirs(args.cache_dir,exist_ok=True)
+    return os.path.join(args.cache_dir,"{}_{}".format(model,key))
+
+
+
+def _prebuild_chunk(fmtl,idxs):
+    """
+    pool_map task: a chunk of mapped tuples as flat columns (see CorpusWriter.write_flat)
+    """
+    fields = list(zip(*fmtl.get_batch(idxs)))
+    tokens,sent_offsets,review_offsets = flatten_reviews(fields[2])
+    aspects = np.array(fields[4:],dtype=np.float32).reshape(len(fields)-4,len(idxs)).T
+    return tokens,sent_offsets,review_offsets,fields[0],fields[1],fields[3],aspects
+
+
+def prebuild(fmtl,wdict,splits=None,workers=0,chunk_size=10000):
+    """
+    Applies all of a FMTL's mappings once, straight into an in-memory Corpus (token ids, offsets and id columns
+    in numpy arrays instead of python lists of lists). Chunks are mapped in a pool of workers processes if > 0.
+    Returns a FMTL over it, whose only mapping left turns reviews back to lists (see ReviewMapper).
+    """
+    rows = tuple(sorted(fmtl.rows,key=fmtl.rows.get))
+    writer = CorpusWriter(None,rows,vocab=wdict)
+    splits = np.zeros(len(fmtl),dtype=np.int8) if splits is None else np.asarray(splits)
+    chunks = [range(start,min(start+chunk_size,len(fmtl))) for start in range(0,len(fmtl),chunk_size)]
+
+    results = pool_map(_prebuild_chunk,fmtl,chunks,workers)
+    raw = [(3+f,d) for f,d in ((0,writer.users),(1,writer.items)) if f not in fmtl.mappings] # unmapped users/items are numbered, as in Corpus.from_tuples
+
+    try:
+        for idxs,res in zip(chunks,tqdm(results,total=len(chunks),desc="Prebuilding")):
+            res = list(res)
+            for col,d in raw:
+                res[col] = [d.setdefault(x,len(d)) for x in res[col]]
+            writer.write_flat(*res,splits[idxs.start:idxs.stop])
+    finally:
+        results.close() # shuts the pool down, even on errors
+
+    data_tl = FMTL(writer.close(),rows)
+    data_tl.set_mapping("review",ReviewMapper(None))
+    return data_tl
+
 
 def FMTL_train_val_test(datatuples,splits,split_num=0,validation=0.5,rows=None):
     """
@@ -0,0 +1,146 @@
+#vocab.py
+import os
+import json
+import hashlib
+import heapq
+import numpy as np
+from collections import Counter
+from tqdm import tqdm
+
+from corpus import fingerprint, cache_key
+from Data import pool_map
+
+
+class CountMinSketch():
+    """
+    Approximate word counts in a fixed [depth, width] int64 table: estimates are upper bounds of the true counts.
+    Hashes don't depend on the process (unlike hash()), so sketches of different workers can be summed.
+    """
+
+    def __init__(self,width=1<<20,depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth,width),dtype=np.int64)
+
+    def _cells(self,words):
+        h = np.array([int.from_bytes(hashlib.blake2b(w.encode("utf-8"),digest_size=8).digest(),"little") for w in words],dtype=np.uint64)
+        h1,h2 = h & np.uint64(0xffffffff),h >> np.uint64(32)
+        i = np.arange(self.depth,dtype=np.uint64)[:,None]
+        return ((h1[None,:] + i*h2[None,:]) % np.uint64(self.width)).astype(np.int64) # [depth, n_words]
+
+    def add(self,words,counts):
+        cells = self._cells(words)
+        for d in range(self.depth):
+            np.add.at(self.table[d],cells[d],counts)
+
+    def estimate(self,words):
+        cells = self._cells(words)
+        return self.table[np.arange(self.depth)[:,None],cells].min(0)
+
+    def merge(self,other):
+        self.table += other.table
+
+
+class HeavyHitters():
+    """
+    Count-min sketch of every word plus a table of the capacity words with the highest estimated counts:
+    memory is bounded by the sketch size and capacity, not by the number of distinct words (typo tails).
+    """
+
+    def __init__(self,capacity,width=1<<20,depth=4):
+        self.capacity = capacity
+        self.sketch = CountMinSketch(width,depth)
+        self.top = {}
+
+    def _prune(self):
+        if len(self.top) > self.capacity: # ties broken by word, as in most_common, whatever the set order
+            self.top = dict(heapq.nsmallest(self.capacity,self.top.items(),key=lambda x:(-x[1],x[0])))
+
+    def update(self,counter):
+        words = list(counter)
+        if len(words) == 0:
+            return
+        self.sketch.add(words,np.fromiter(counter.values(),dtype=np.int64,count=len(words)))
+        words = list(set(words) | set(self.top))
+        self.top = dict(zip(words,self.sketch.estimate(words).tolist()))
+        self._prune()
+
+    def most_common(self):
+        return sorted(self.top.items(),key=lambda x:(-x[1],x[0]))
+
+
+def _count_shard(counting,idxs):
+    """
+    pool_map task: exact word Counter of a shard of reviews. counting is (fmtl, review field, key)
+    """
+    fmtl,r_field,key = counting
+    counts = Counter()
+
+    for i in idxs:
+        for s in fmtl.tuplelist[i][r_field]:
+            counts.update(s if key is None else map(key,s))
+
+    return counts
+
+
+def count_words(fmtl,idxs,key=None,workers=0,capacity=None,shard_size=50000):
+    """
+    (word,count) list of the reviews in idxs, by decreasing count (then word).
+    Corpus storage is counted with numpy (see Corpus.word_counts). Tuples are counted by shards, in a pool of workers
+    processes if > 0, and summed. With capacity, shard counts go through a single HeavyHitters instead (only shard sized
+    Counters are sent by workers): counts are approximate and only the capacity most common words are kept.
+    Corpus storage counts are exact, capacity then only truncates them.
+    """
+    if hasattr(fmtl.tuplelist,"word_counts"):
+        counts = fmtl.tuplelist.word_counts(idxs,key)
+        if capacity:
+            print("WARNING: columnar storage is counted exactly, approximate counting only keeps the {} most common words".format(capacity))
+            counts = counts[:capacity]
+        return counts
+
+    shards = [idxs[i:i+shard_size] for i in range(0,len(idxs),shard_size)]
+    results = pool_map(_count_shard,(fmtl,fmtl._f2i("review"),key),shards,workers)
+    total = HeavyHitters(capacity) if capacity else Counter()
+
+    for counts in tqdm(results,total=len(shards),desc="Counting words" + (" ({} workers)".format(workers) if workers > 0 else "")):
+        total.update(counts)
+
+    if isinstance(total,HeavyHitters):
+        return total.most_common()
+    return sorted(total.items(),key=lambda x:(-x[1],x[0]))
+
+
+def vocab_dict(counts,offset=0,max_count=-1):
+    """
+    {word:id} of the max_count most common words (all if -1), ids start at offset
+    """
+    if max_count > -1:
+        counts = counts[:max_count]
+    return {w:i for i,(w,_) in enumerate(counts,offset)}
+
+
+def build_vocab(args,fmtl,idxs,model,key=None):
+    """
+    Word dict (ids from 2) of the training reviews, limited to --max-feat words.
+    With --cache-dir, the full sorted counts are saved there: runs with another --max-feat reuse them.
+    """
+    path = None
+    if args.cache_dir:
+        path = os.path.join(args.cache_dir,"vocab_{}_{}.json".format(model,cache_key(model,fingerprint(args.filename),args.split,args.vocab_approx)))
+
+    if path is not None and os.path.exists(path):
+        print("==> Loading word counts from {}".format(path))
+        with open(path) as f:
+            counts = [tuple(x) for x in json.load(f)]
+    else:
+        counts = count_words(fmtl,idxs,key=key,workers=args.vocab_workers,capacity=args.vocab_approx)
+        if path is not None:
+            os.makedirs(args.cache_dir,exist_ok=True)
+            with open(path+".tmp","w") as f:
+                json.dump(counts,f)
+            os.rename(path+".tmp",path)
+
+    if args.vocab_approx and args.max_feat > args.vocab_approx:
+        print("WARNING: --max-feat {} is over --vocab-approx {}, only {} words are known".format(args.max_feat,args.vocab_approx,len(counts)))
+
+    return vocab_dict(counts,offset=2,max_count=args.max_feat)